@@ -12,7 +12,15 @@ import subprocess
 import sys
 import uuid
 
+import dbcache
+import hashing
 import par_upload
+import progress
+import resources
+import retry
+import s3
+import stream_upload
+import throttle
 import validate
 import nanopore
 
@@ -123,26 +131,26 @@ out_fieldnames.append("clean_file_sha1")
 out_fieldnames.append("clean_file_sha512")
 
 
-def hash_file(filename):
-    hashmd5 = (
-        subprocess.check_output(shlex.split(f"md5sum {filename}"))
-        .strip()
-        .split()[0]
-        .decode()
-    )
-    hashsha1 = (
-        subprocess.check_output(shlex.split(f"sha1sum {filename}"))
-        .strip()
-        .split()[0]
-        .decode()
+def get_digest_cache():
+    """
+    return the digest cache from the config, or None if it's disabled
+    """
+    digest_cache_cfg = cfg.get("digest_cache", dict())
+    if digest_cache_cfg is None:
+        return None
+    return hashing.DigestCache(
+        digest_cache_cfg.get("path", "digest_cache.json"),
+        int(digest_cache_cfg.get("max_entries", 10000)),
     )
-    hashsha512 = (
-        subprocess.check_output(shlex.split(f"sha512sum {filename}"))
-        .strip()
-        .split()[0]
-        .decode()
+
+
+def hash_files(filenames, digest_dir=None):
+    return hashing.hash_files(
+        filenames,
+        int(cfg.get("hash_workers", 4)),
+        cache=get_digest_cache(),
+        digest_dir=digest_dir,
     )
-    return hashmd5, hashsha1, hashsha512
 
 
 map_fieldnames = ["sample_name", "sample_uuid4", "original_file", "renamed_file"]
@@ -165,7 +173,15 @@ def step_msg(step, state, **kwargs):
             logging.info(f"\n*** Next step: {steps[step+1]}\n")
 
 
-def nanopore_prepare(submission_name):
+def nanopore_prepare(submission_name, follow=False):
+    """
+    Bring the nanopore run into a format that can be accepted by the
+    preprocessing pipeline (step 1.5)
+
+    With follow, the run can still be being sequenced: new chunks are
+    added to the outputs as MinKNOW writes them, until the run finishes
+    """
+
     def api_begin():
         (pathlib.Path(submission_name) / ".step1.5-running").touch(exist_ok=True)
         unlink_missing_ok(pathlib.Path(submission_name) / ".step1.5-ok")
@@ -182,6 +198,13 @@ def nanopore_prepare(submission_name):
         (pathlib.Path(submission_name) / ".step1.5-ok").touch(exist_ok=True)
         unlink_missing_ok(pathlib.Path(submission_name) / ".step1.5-error")
 
+    def api_progress(status):
+        running = pathlib.Path(submission_name) / ".step1.5-running"
+        tmp = running.with_name(running.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps(status))
+        os.replace(tmp, running)
+
     api_begin()
 
     nanopore_variant = open(
@@ -192,27 +215,89 @@ def nanopore_prepare(submission_name):
     if nanopore_variant:
         nanopore_output_dir = pathlib.Path(submission_name) / "nanopore_concated"
         nanopore_output_dir.mkdir(exist_ok=True)
-        nanopore_cmds = list()
+        nanopore_jobs = list()
+        inventory_file = pathlib.Path(submission_name) / ".nanopore_inventory"
+        inventory = nanopore.Inventory.load(inventory_file, input_dir)
+
+        def refresh_inventory(full=False):
+            try:
+                inventory.refresh(full)
+                inventory.save(inventory_file)
+            except OSError as e:
+                logging.error(f"Couldn't list {input_dir}: {e}")
+            return inventory
+
+        refresh_inventory()
 
         if nanopore_variant == "multiplexed_v1":
-            nanopore_cmds = nanopore.nanopore_multiplexed_preprocess(
-                input_dir, str(nanopore_output_dir)
+            nanopore_jobs = nanopore.nanopore_multiplexed_preprocess(
+                input_dir, str(nanopore_output_dir), inventory
             )
 
         if nanopore_variant == "notmultiplexed_v1":
-            nanopore_cmds = nanopore.nanopore_notmultiplexed_preprocess(
-                input_dir, str(nanopore_output_dir)
+            nanopore_jobs = nanopore.nanopore_notmultiplexed_preprocess(
+                input_dir, str(nanopore_output_dir), inventory
             )
 
         if nanopore_variant == "dirfiles_v1":
-            nanopore_cmds = nanopore.nanopore_dirfiles_preprocess(
-                input_dir, str(nanopore_output_dir)
+            nanopore_jobs = nanopore.nanopore_dirfiles_preprocess(
+                input_dir, str(nanopore_output_dir), inventory
+            )
+
+        if nanopore_jobs is False:
+            api_error(
+                {"status": "failure", "reason": "no_input_dir", "input_dir": input_dir}
             )
+            sys.exit(1)
 
-        for cmds_list in nanopore_cmds:
-            for cmd in cmds_list:
-                logging.info(cmd)
-                os.system(cmd)
+        nanopore_workers = int(cfg.get("nanopore_workers", 4))
+        # nanopore_workers barcodes are compressed at once. share the cores
+        default_gzip_threads = max(1, (os.cpu_count() or 1) // nanopore_workers)
+        gzip_threads = int(cfg.get("nanopore_gzip_threads", default_gzip_threads))
+        ledger = nanopore.ChunkLedger(
+            pathlib.Path(submission_name) / ".nanopore_chunks"
+        )
+
+        if follow and nanopore_variant in ["multiplexed_v1", "notmultiplexed_v1"]:
+            if nanopore_variant == "multiplexed_v1":
+                make_jobs = nanopore.nanopore_multiplexed_preprocess
+            else:
+                make_jobs = nanopore.nanopore_notmultiplexed_preprocess
+            logging.info(f"Following nanopore run in {input_dir}")
+            errors = nanopore.follow_run(
+                lambda final: make_jobs(
+                    input_dir, str(nanopore_output_dir), refresh_inventory(final)
+                ),
+                input_dir,
+                ledger,
+                int(cfg.get("nanopore_follow_interval", 60)),
+                int(cfg.get("nanopore_follow_idle_timeout", 3600)),
+                nanopore_workers,
+                api_progress,
+                int(cfg.get("nanopore_gzip_level", 6)),
+                gzip_threads,
+            )
+        else:
+            for job in nanopore_jobs:
+                logging.info(f"{job['action']} {job['input']} {job['output']}")
+            errors = nanopore.run_jobs(
+                nanopore_jobs,
+                nanopore_workers,
+                api_progress,
+                int(cfg.get("nanopore_gzip_level", 6)),
+                gzip_threads,
+                ledger,
+            )
+        if errors:
+            api_error(
+                {
+                    "status": "failure",
+                    "reason": "nanopore_preprocessing_failed",
+                    "more": next(iter(errors.values())),
+                    "failed": errors,
+                }
+            )
+            sys.exit(1)
 
     api_success()
 
@@ -365,13 +450,16 @@ def prepare_data(submission_name):
 
         submission_uuid4 = str(uuid.uuid4())
 
-        for row in reader:
+        rows = list(reader)
+        digests = hash_files([row["sample_filename"] for row in rows])
+
+        for row, digest in zip(rows, digests):
             out = copy.copy(row)
             (
                 out["original_file_md5"],
                 out["original_file_sha1"],
                 out["original_file_sha512"],
-            ) = hash_file(out["sample_filename"])
+            ) = digest
             out["clean_file_md5"], out["clean_file_sha1"], out["clean_file_sha512"] = (
                 "",
                 "",
@@ -434,17 +522,29 @@ def make_clean_filename(sample_uuid4, subindex, sample_file_extension):
 
 def hash_clean_files(submission_name):
     submission_uuid4 = None
-    for writer, row in process_csv(f"{submission_name}/sp3data.csv"):
+    directory = f"{submission_name}/upload/"
+    with open(f"{submission_name}/sp3data.csv") as infile:
+        filenames = [
+            make_clean_filename(
+                row["sample_uuid4"], row["subindex"], row["sample_file_extension"]
+            )
+            for row in csv.DictReader(infile)
+        ]
+    # the pipeline leaves a sidecar with the digests of every clean file it
+    # publishes; files without one are hashed here
+    digests = hash_files(
+        [directory + "/" + filename for filename in filenames],
+        digest_dir=f"{submission_name}/upload_digests",
+    )
+    for (writer, row), filename, digest in zip(
+        process_csv(f"{submission_name}/sp3data.csv"), filenames, digests
+    ):
         submission_uuid4 = row["submission_uuid4"]
-        directory = f"{submission_name}/upload/"
-        filename = make_clean_filename(
-            row["sample_uuid4"], row["subindex"], row["sample_file_extension"]
-        )
         (
             row["clean_file_md5"],
             row["clean_file_sha1"],
             row["clean_file_sha512"],
-        ) = hash_file(directory + "/" + filename)
+        ) = digest
         row["sample_filename"] = filename
         writer.writerow(row)
     return submission_uuid4
@@ -504,19 +604,46 @@ def run_pipeline(submission_name, number_of_files_per_sample):
     step_msg(3, "begin")
     logging.info(f"Running pipeline: {pipeline}")
 
+    staged_db = stage_db(pipeline_human_ref)
+    pipeline_human_ref = staged_db.path
+
     if number_of_files_per_sample == 2:
-        nf_cmd = f"nextflow {pipeline_script} {nextflow_additional_params} --input_dir ../pipeline_in/ --read_pattern '*_{{1,2}}.fastq.gz' --paired true --output_dir ../upload -with-{container} {pipeline_image} --db {pipeline_human_ref}"
+        nf_cmd = f"nextflow {pipeline_script} {nextflow_additional_params} --input_dir ../pipeline_in/ --read_pattern '*_{{1,2}}.fastq.gz' --paired true --output_dir ../upload --digest_dir ../upload_digests -with-{container} {pipeline_image} --db {pipeline_human_ref}"
     if number_of_files_per_sample == 1:
-        nf_cmd = f"nextflow {pipeline_script} {nextflow_additional_params} {ont_param} --input_dir ../pipeline_in/ --read_pattern '*_1.fastq.gz' --paired false --output_dir ../upload -with-{container} {pipeline_image} --db {pipeline_human_ref}"
+        nf_cmd = f"nextflow {pipeline_script} {nextflow_additional_params} {ont_param} --input_dir ../pipeline_in/ --read_pattern '*_1.fastq.gz' --paired false --output_dir ../upload --digest_dir ../upload_digests -with-{container} {pipeline_image} --db {pipeline_human_ref}"
 
     new_dir = f"{submission_name}/pipeline_run"
     pathlib.Path(new_dir).mkdir(exist_ok=True)
+
+    if cfg.get("pipeline_resources", True):
+        # size the processes for this run's samples, and this host if
+        # nextflow runs them here
+        try:
+            resources.write_config(
+                pathlib.Path(new_dir) / "resources.config",
+                *resources.plan(
+                    pathlib.Path(submission_name) / "pipeline_in",
+                    pipeline_human_ref,
+                    local=resources.is_local_executor(nextflow_additional_params),
+                ),
+            )
+            nf_cmd += " -c resources.config"
+        except Exception as e:
+            logging.error(f"Couldn't plan pipeline resources: {e}")
+
     logging.info(f"Changing directory to: {new_dir}")
     logging.info(f"Nextflow invocation: {nf_cmd}")
 
+    try:
+        streamer = start_streaming_upload(submission_name)
+    except Exception as e:
+        logging.error(f"Couldn't start streaming upload: {e}")
+        streamer = None
     try:
         subprocess.check_output(shlex.split(nf_cmd), cwd=str(new_dir))
     except subprocess.CalledProcessError as e:
+        if streamer:
+            streamer.finish()
         api_error(
             {
                 "status": "failure",
@@ -526,10 +653,21 @@ def run_pipeline(submission_name, number_of_files_per_sample):
         )
         sys.exit(1)
     except Exception as e:
+        if streamer:
+            streamer.finish()
         api_error(
             {"status": "failure", "reason": "unknown_error", "python_exception": str(e)}
         )
         sys.exit(1)
+    finally:
+        staged_db.release()
+
+    if streamer:
+        errors = streamer.finish()
+        if errors:
+            logging.warning(
+                f"{len(errors)} files failed to upload early, step 4 will retry them"
+            )
 
     if not (pathlib.Path(submission_name) / "upload").is_dir():
         api_error({"status": "failure", "reason": "no_upload_dir"})
@@ -548,11 +686,123 @@ def run_pipeline(submission_name, number_of_files_per_sample):
     step_msg(3, "end")
 
 
+def stage_db(db):
+    """
+    Return a dbcache.StagedDb for the local copy of db in the database
+    cache, or for db itself if the cache is disabled or staging fails
+    """
+    db_cache_cfg = cfg.get("db_cache")
+    if not db_cache_cfg:
+        return dbcache.StagedDb(db)
+    try:
+        cache = dbcache.DbCache(
+            db_cache_cfg["path"],
+            int(float(db_cache_cfg.get("max_size_gb", 100)) * dbcache.GB),
+        )
+        return cache.stage(db)
+    except Exception as e:
+        logging.error(f"Couldn't copy {db} to the database cache: {e}")
+        return dbcache.StagedDb(db)
+
+
+def upload_target(submission_name):
+    """
+    Return the par_url and bucket that the submission is uploaded to
+    """
+    try:
+        with open(pathlib.Path(submission_name) / ".par_url") as f:
+            par_url = f.read().strip()
+    except Exception:
+        par_url = None
+    if not par_url:
+        par_url = cfg.get("upload").get("s3").get("par_url")
+    bucket = cfg.get("upload").get("s3").get("bucket")
+    return par_url, bucket
+
+
+def par_upload_args():
+    return (
+        int(cfg.get("upload_workers", 4)),
+        int(cfg.get("upload_multipart_threshold", par_upload.MULTIPART_THRESHOLD)),
+        int(cfg.get("upload_part_size", par_upload.PART_SIZE)),
+        retry.RetryPolicy(**cfg.get("upload_retry", dict())),
+    )
+
+
+def start_streaming_upload(submission_name):
+    """
+    If streaming_upload is enabled, start uploading the clean files as
+    the pipeline publishes them. Return the StreamingUploader or None
+    """
+    if not cfg.get("streaming_upload"):
+        return None
+    par_url, bucket = upload_target(submission_name)
+    with open(f"{submission_name}/sp3data.csv") as infile:
+        rows = list(csv.DictReader(infile))
+    if not rows:
+        return None
+    submission_uuid4 = rows[0]["submission_uuid4"]
+    filenames = [
+        make_clean_filename(
+            row["sample_uuid4"], row["subindex"], row["sample_file_extension"]
+        )
+        for row in rows
+    ]
+    throttle.LIMITER.set_rate(throttle.mbps_to_bytes(cfg.get("upload_bandwidth_mbps")))
+    workers, multipart_threshold, part_size, policy = par_upload_args()
+
+    if par_url:
+        destination = f"{par_url}{submission_uuid4}"
+
+        def upload_fn(u_file):
+            with throttle.LIMITER.activate(submission_uuid4):
+                return par_upload.upload_file(
+                    par_url,
+                    u_file,
+                    submission_uuid4,
+                    multipart_threshold,
+                    part_size,
+                    policy,
+                )
+
+    elif bucket:
+        destination = f"s3://{s3.bucket_name(bucket)}/{submission_uuid4}/"
+        client = s3.S3Client.from_config(cfg.get("upload").get("s3"))
+
+        def upload_fn(u_file):
+            with throttle.LIMITER.activate(submission_uuid4):
+                return s3.upload_file(
+                    client,
+                    bucket,
+                    u_file,
+                    submission_uuid4,
+                    multipart_threshold,
+                    part_size,
+                    policy,
+                )
+
+    else:
+        return None
+
+    logging.info(f"Uploading clean files to {destination} as they are published")
+    streamer = stream_upload.StreamingUploader(
+        f"{submission_name}/upload",
+        f"{submission_name}/upload_digests",
+        filenames,
+        par_upload.open_journal(f"{submission_name}/upload", destination),
+        upload_fn,
+        workers,
+    )
+    streamer.start()
+    return streamer
+
+
 def upload_to_sp3(submission_name):
     def api_begin():
         (pathlib.Path(submission_name) / ".step4-running").touch(exist_ok=True)
         unlink_missing_ok(pathlib.Path(submission_name) / ".step4-ok")
         unlink_missing_ok(pathlib.Path(submission_name) / ".step4-error")
+        unlink_missing_ok(pathlib.Path(submission_name) / ".step4-progress.json")
 
     def api_error(err_dict):
         unlink_missing_ok(pathlib.Path(submission_name) / ".step4-running")
@@ -569,11 +819,12 @@ def upload_to_sp3(submission_name):
     step_msg(4, "begin")
     logging.info("Uploading to S3")
 
-    try:
-        with open(pathlib.Path(submission_name) / ".par_url") as f:
-            par_url = f.read().strip()
-    except Exception:
-        par_url = None
+    throttle.LIMITER.set_rate(throttle.mbps_to_bytes(cfg.get("upload_bandwidth_mbps")))
+    tracker = progress.UploadProgress(
+        pathlib.Path(submission_name) / ".step4-progress.json"
+    )
+
+    par_url, bucket = upload_target(submission_name)
 
     try:
         submission_uuid4 = hash_clean_files(submission_name)
@@ -595,10 +846,6 @@ def upload_to_sp3(submission_name):
     d = pathlib.Path(f"{submission_name}/upload/sp3data.csv")
     shutil.copy(s, d)
 
-    bucket = cfg.get("upload").get("s3").get("bucket")
-
-    if not par_url:
-        par_url = cfg.get("upload").get("s3").get("par_url")
     if not bucket and not par_url:
         logging.error(
             "You need either an upload.s3.bucket key or an upload.s3.par_url key"
@@ -609,7 +856,9 @@ def upload_to_sp3(submission_name):
     if par_url:
         # upload to oracle s3 with preauthenticated request
         try:
-            error = par_upload.upload_run(par_url, submission_name)
+            error = par_upload.upload_run(
+                par_url, submission_name, *par_upload_args(), tracker
+            )
             if error:
                 api_error(
                     {
@@ -640,20 +889,38 @@ def upload_to_sp3(submission_name):
             sys.exit(1)
 
     if bucket:
-        # upload to bucket with s3cmd
-        s3cmd_config = cfg.get("upload").get("s3").get("s3cmd-config")
-        files = " ".join(
-            [str(x) for x in pathlib.Path(f"{submission_name}/upload/").glob("*")]
-        )
-        s3cmd = f"s3cmd -c {s3cmd_config} put {files} {bucket}/{submission_uuid4}/"
-        logging.info(f"s3cmd invocation: {s3cmd}")
+        # upload to an S3-compatible bucket
         try:
-            subprocess.check_output(shlex.split(s3cmd))
-        except subprocess.CalledProcessError:
-            api_error({"status": "failure", "reason": "s3cmd_failed"})
+            client = s3.S3Client.from_config(cfg.get("upload").get("s3"))
+            error = s3.upload_dir(
+                client,
+                bucket,
+                f"{submission_name}/upload",
+                submission_uuid4,
+                *par_upload_args(),
+                tracker,
+            )
+        except Exception as e:
+            error = {"error_exception_str": str(e)}
+        if error:
+            api_error(
+                {
+                    "status": "failure",
+                    "reason": "s3_upload_failed",
+                    "more": error,
+                    "bucket": bucket,
+                    "files": [
+                        str(x) for x in pathlib.Path(submission_name).glob("upload/*")
+                    ],
+                }
+            )
             sys.exit(1)
         logging.info(f"Uploaded files to: {bucket}/{submission_uuid4}")
 
+    status = tracker.status()
+    logging.info(
+        f"Uploaded {status['bytes_sent']} bytes in {status['elapsed']} seconds"
+    )
     step_msg(4, "end")
     api_success()
 
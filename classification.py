@@ -0,0 +1,95 @@
+"""
+Per-read classification tables.
+
+kraken2 and centrifuge write one tab-separated row per read. split reads
+the table once, line by line, and writes the human read IDs as it goes,
+so memory use does not grow with the depth of the sample. The pipelines
+remove the human reads by excluding these IDs, so the much longer list of
+non-human read IDs is only written when asked for.
+
+The layouts differ in where the read ID is:
+
+    kraken2:    C/U, read ID, taxonomy ID, ...
+    centrifuge: read ID, sequence ID, taxonomy ID, ...
+
+centrifuge also starts its table with a header row, which is skipped.
+
+The classification processes run this in their containers, where only
+the standard library can be relied on.
+"""
+
+import argparse
+import sys
+
+HUMAN_TAXID = b"9606"
+
+LAYOUTS = {
+    # layout: (read ID column, taxonomy ID column, header row prefix)
+    "kraken2": (1, 2, None),
+    "centrifuge": (0, 2, b"readID\t"),
+}
+
+
+def split_stream(
+    in_f, human_f, non_human_f=None, layout="kraken2", taxid=HUMAN_TAXID
+):
+    """
+    Write the read IDs of the rows in in_f classified as taxid to human_f
+    and, if given, the others to non_human_f. Returns the (human,
+    non-human) counts
+    """
+    id_col, taxid_col, header = LAYOUTS[layout]
+    max_split = taxid_col + 1
+    counts = [0, 0]
+    for line in in_f:
+        if header and line.startswith(header):
+            continue
+        row = line.split(b"\t", max_split)
+        if len(row) <= taxid_col:
+            continue
+        if row[taxid_col].strip() == taxid:
+            human_f.write(row[id_col] + b"\n")
+            counts[0] += 1
+        else:
+            if non_human_f:
+                non_human_f.write(row[id_col] + b"\n")
+            counts[1] += 1
+    return counts
+
+
+def split(classification, human_list, non_human_list=None, layout="kraken2"):
+    """
+    Write the human read IDs of a kraken2 or centrifuge per-read
+    classification to human_list, appending them to what is already
+    there, and the other read IDs to non_human_list if given
+    """
+    with open(classification, "rb") as in_f, open(human_list, "ab") as human_f:
+        if non_human_list:
+            with open(non_human_list, "wb") as non_human_f:
+                human, non_human = split_stream(in_f, human_f, non_human_f, layout)
+        else:
+            human, non_human = split_stream(in_f, human_f, None, layout)
+    print(f"{human} human reads, {non_human} other reads")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-read classification tables")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser(
+        "split", help="write the human (and other) read IDs of a classification"
+    )
+    p.add_argument("classification")
+    p.add_argument("human_list")
+    p.add_argument("--non-human-list")
+    p.add_argument("--layout", choices=sorted(LAYOUTS), default="kraken2")
+    args = parser.parse_args(argv)
+
+    if args.command == "split":
+        split(args.classification, args.human_list, args.non_human_list, args.layout)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Local copies of the human reference databases.
+
+The kraken2 and centrifuge databases usually live on a network mount,
+and every classification task would otherwise read the whole database
+over the network. A DbCache keeps copies of them in a directory on local
+storage (an SSD or a tmpfs), so a database is copied once per host.
+
+An entry is only used while the size and mtime of every file of the
+source database are the same as when it was copied, and its own files
+are all there with the same sizes; otherwise it is copied again. When
+the copies would take more than max_size bytes, the least recently used
+ones are removed first.
+
+A database is staged under an exclusive lock on the cache directory, so
+that several catsup processes on the same host copy it only once. Each
+run that uses a copy holds a shared lock on its lease file until
+release(). A copy that is leased by a run is never evicted.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+
+import argh
+
+GB = 1024 * 1024 * 1024
+
+
+class StagedDb:
+    def __init__(self, path, lease=None):
+        """
+        path is the database to give to the classifier. lease is the open
+        lease file of a cached copy, or None for the source database
+        """
+        self.path = str(path)
+        self.lease = lease
+
+    def release(self):
+        if self.lease:
+            self.lease.close()
+            self.lease = None
+
+
+def db_files(db):
+    """
+    Return the files of a database: a kraken2 database is a directory and a
+    centrifuge index is the prefix of its .cf files
+    """
+    db = pathlib.Path(db)
+    if db.is_dir():
+        return sorted(f for f in db.rglob("*") if f.is_file())
+    return sorted(f for f in db.parent.glob(db.name + ".*") if f.is_file())
+
+
+def signature(db):
+    """
+    [relative path, size, mtime] of every file of a database
+    """
+    db = pathlib.Path(db)
+    base = db if db.is_dir() else db.parent
+    sig = list()
+    for f in db_files(db):
+        st = f.stat()
+        sig.append([str(f.relative_to(base)), st.st_size, st.st_mtime_ns])
+    return sig
+
+
+class DbCache:
+    def __init__(self, path, max_size):
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.index_file = self.path / "index.json"
+
+    def key(self, db):
+        """
+        Name of the copy of db in the cache
+        """
+        real = os.path.realpath(db)
+        digest = hashlib.sha1(real.encode()).hexdigest()[:12]
+        return f"{pathlib.Path(real).name}-{digest}"
+
+    def load(self):
+        try:
+            with open(self.index_file) as f:
+                index = json.loads(f.read())
+            if type(index) == dict:
+                return index
+        except (OSError, ValueError):
+            pass
+        return dict()
+
+    def save(self, index):
+        tmp = self.path / f".index.json.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(index))
+        os.replace(tmp, self.index_file)
+
+    def lease(self, key):
+        """
+        Open the lease file of a copy, holding a shared lock on it
+        """
+        f = open(self.path / f"{key}.lease", "a")
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return f
+
+    def remove(self, key):
+        """
+        Remove a copy unless a run is using it. Returns True if removed
+        """
+        with open(self.path / f"{key}.lease", "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            shutil.rmtree(self.path / key, ignore_errors=True)
+            return True
+
+    def evict(self, index, needed):
+        """
+        Remove least recently used copies until needed bytes fit. Returns
+        False if they can't be made to fit
+        """
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda x: index[x]["used"]):
+            if total + needed <= self.max_size:
+                break
+            if self.remove(key):
+                logging.info(f"Evicted {index[key]['source']} from {self.path}")
+                total -= index[key]["size"]
+                del index[key]
+        return total + needed <= self.max_size
+
+    def intact(self, key, sig):
+        """
+        Whether every file of the copy key is there with the size in sig,
+        eg. not lost to a copy that failed part way or a cleaned out tmpfs
+        """
+        for name, size, _ in sig:
+            try:
+                if (self.path / key / name).stat().st_size != size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def copy(self, db, key):
+        """
+        Copy the files of db to the cache entry key
+        """
+        db = pathlib.Path(db)
+        base = db if db.is_dir() else db.parent
+        tmp = self.path / f"{key}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        for f in db_files(db):
+            dest = tmp / f.relative_to(base)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(f, dest)
+        shutil.rmtree(self.path / key, ignore_errors=True)
+        os.replace(tmp, self.path / key)
+
+    def stage(self, db):
+        """
+        Return a StagedDb for the local copy of db, copying it first if
+        there is no current copy. If db doesn't fit in the cache, the
+        StagedDb is db itself
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.load()
+            key = self.key(db)
+            sig = signature(db)
+            entry = index.get(key)
+            if not entry or entry["signature"] != sig or not self.intact(key, sig):
+                if entry and not self.remove(key):
+                    # the copy is out of date, but a run is still using it
+                    logging.warning(f"{db} has changed or its copy is damaged")
+                    return StagedDb(db)
+                index.pop(key, None)
+                size = sum(x[1] for x in sig)
+                if not sig or not self.evict(index, size):
+                    self.save(index)
+                    logging.warning(f"{db} doesn't fit in {self.path}")
+                    return StagedDb(db)
+                # the evicted copies are gone even if this copy fails
+                self.save(index)
+                logging.info(f"Copying {db} to {self.path / key}")
+                t0 = time.monotonic()
+                self.copy(db, key)
+                logging.info(f"Copied {size} bytes in {time.monotonic() - t0:.0f}s")
+                entry = {
+                    "source": os.path.realpath(db),
+                    "signature": sig,
+                    "size": size,
+                }
+                index[key] = entry
+            entry["used"] = time.time()
+            self.save(index)
+            lease = self.lease(key)
+
+        local = self.path / key
+        if not pathlib.Path(db).is_dir():
+            local = local / pathlib.Path(db).name
+        return StagedDb(local, lease)
+
+
+def stage(db, cache_dir, max_size_gb=100):
+    """
+    Copy db to cache_dir if needed and print the path of the local copy
+    """
+    staged = DbCache(cache_dir, int(float(max_size_gb) * GB)).stage(db)
+    print(staged.path)
+    staged.release()
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([stage])
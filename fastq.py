@@ -0,0 +1,183 @@
+"""
+FASTQ stream processing for the pipelines.
+
+FASTQ is read in large blocks and split into lines once per block. Only
+complete four-line records are processed; a record cut by the end of a
+block is carried over to the next one. Headers are every fourth line of
+a record block, so sequence and quality lines are never inspected.
+
+fastq.py filter fixes the headers and keeps or, with --exclude, drops the
+reads named in a read list in the same pass, so the pipelines can go from
+the trimmed reads to the clean file without writing anything in between.
+The read list is held as a readset.ReadSet, at 8 bytes per read.
+
+This runs inside the pipeline containers, so it needs nothing outside
+the standard library.
+"""
+
+import argparse
+import sys
+
+import readset
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def strip_read_number(header: bytes) -> bytes:
+    """
+    @name/1 -> @name, if name has no spaces or tabs. Other headers are
+    returned as they are
+    """
+    name, slash, number = header.rpartition(b"/")
+    if (
+        slash
+        and number.isdigit()
+        and len(name) > 1
+        and name[:1] == b"@"
+        and b" " not in name
+        and b"\t" not in name
+    ):
+        return name
+    return header
+
+
+def records(in_f, block_size=BLOCK_SIZE):
+    """
+    Yield (lines, ends_with_newline), where lines (without newlines)
+    hold whole records from in_f. The last lines are whatever is left at
+    the end of the input, which may not end in a newline
+    """
+    rest = b""
+    while True:
+        block = in_f.read(block_size)
+        if not block:
+            break
+        lines = (rest + block).split(b"\n")
+        partial = lines.pop()
+        n = len(lines) // 4 * 4
+        rest = b"\n".join(lines[n:] + [partial])
+        if n:
+            yield lines[:n], True
+    if rest:
+        yield rest.split(b"\n"), False
+
+
+def fix_headers_stream(in_f, out_f, block_size=BLOCK_SIZE):
+    """
+    Copy FASTQ from in_f to out_f, removing /1 and /2 read numbers from
+    the headers
+    """
+    for lines, ends_with_newline in records(in_f, block_size):
+        lines[0::4] = [strip_read_number(x) for x in lines[0::4]]
+        out_f.write(b"\n".join(lines))
+        if ends_with_newline:
+            out_f.write(b"\n")
+
+
+def read_name(header: bytes) -> bytes:
+    """
+    @name extra -> name
+    """
+    return header[1:].split(None, 1)[0] if len(header) > 1 else b""
+
+
+def is_listed(header: bytes, read_ids) -> bool:
+    """
+    Is the read in read_ids, either by its name as it is or by its name
+    without a /1 or /2 read number? Classifiers report names both ways
+    """
+    name = read_name(header)
+    if name in read_ids:
+        return True
+    short, slash, number = name.rpartition(b"/")
+    return bool(slash and short and number.isdigit() and short in read_ids)
+
+
+def load_read_list(path, after=None):
+    """
+    Return a ReadSet of the read names in path, one per line. Only the
+    first column of a line is used. If after is given, only the lines
+    after the line after are read
+    """
+    with open(path, "rb") as f:
+        if after is not None:
+            after = after.encode() if isinstance(after, str) else after
+            for line in f:
+                if line.rstrip(b"\r\n") == after:
+                    break
+        return readset.ReadSet.from_ids(
+            line.split(None, 1)[0] for line in f if line.strip()
+        )
+
+
+def filter_stream(in_f, out_f, read_ids, exclude=False, block_size=BLOCK_SIZE):
+    """
+    Copy the FASTQ records from in_f that are listed in read_ids (or, with
+    exclude, are not) to out_f, removing /1 and /2 read numbers from the
+    headers
+    """
+    for lines, ends_with_newline in records(in_f, block_size):
+        out = list()
+        for i in range(0, len(lines), 4):
+            if is_listed(lines[i], read_ids) != exclude:
+                out.append(strip_read_number(lines[i]))
+                out.extend(lines[i + 1 : i + 4])
+        if out:
+            out_f.write(b"\n".join(out))
+            if ends_with_newline:
+                out_f.write(b"\n")
+
+
+def fix_headers(block_size=BLOCK_SIZE):
+    """
+    Copy FASTQ from stdin to stdout, removing /1 and /2 read numbers from
+    the headers
+    """
+    fix_headers_stream(sys.stdin.buffer, sys.stdout.buffer, block_size)
+
+
+def filter_reads(read_list, exclude=False, after=None, block_size=BLOCK_SIZE):
+    """
+    Copy the FASTQ records from stdin that are named in read_list (or,
+    with exclude, are not) to stdout, removing /1 and /2 read numbers
+    from the headers. If after is given, only the read names after that
+    line of read_list are used
+    """
+    filter_stream(
+        sys.stdin.buffer,
+        sys.stdout.buffer,
+        load_read_list(read_list, after),
+        exclude,
+        block_size,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FASTQ stream processing")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser(
+        "fix-headers", help="remove /1 and /2 read numbers from the headers"
+    )
+    p.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    p = commands.add_parser(
+        "filter", help="fix the headers and keep or drop the reads in a read list"
+    )
+    p.add_argument("read_list")
+    p.add_argument(
+        "--exclude", action="store_true", help="drop the listed reads instead"
+    )
+    p.add_argument("--after", help="only use the read names after this line")
+    p.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "fix-headers":
+        fix_headers(args.block_size)
+    elif args.command == "filter":
+        filter_reads(args.read_list, args.exclude, args.after, args.block_size)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+File digests for sample and clean files.
+
+Every file is read once, in large blocks, and each block is fed to md5,
+sha1 and sha512 together. The digests are the same as those printed by
+md5sum, sha1sum and sha512sum.
+
+Digests can be kept in an on-disk DigestCache so that unchanged files are
+not read again when a submission is re-staged.
+
+The pipelines write their clean files through tee_digest, which leaves a
+<file>.digests sidecar behind. Step 4 reads those instead of hashing the
+clean files a second time. As the pipelines run this module inside their
+containers, it only uses the standard library.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+
+BLOCK_SIZE = 4 * 1024 * 1024
+DIGEST_SUFFIX = ".digests"
+
+
+class DigestCache:
+    """
+    JSON file of digests keyed by the real path of a file
+
+    An entry is only used while the file's size, mtime and inode are the
+    same as when it was hashed. When there are more than max_entries, the
+    least recently used entries are dropped on save.
+    """
+
+    def __init__(self, path, max_entries=10000):
+        self.path = pathlib.Path(path)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.loads(f.read())
+            if type(entries) == dict:
+                return entries
+        except (OSError, ValueError):
+            pass
+        return dict()
+
+    @staticmethod
+    def identity(filename):
+        st = os.stat(filename)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, filename, identity):
+        with self.lock:
+            entry = self.entries.get(os.path.realpath(filename))
+            if not entry or entry["identity"] != identity:
+                return None
+            entry["used"] = time.time()
+            return tuple(entry["digests"])
+
+    def put(self, filename, identity, digests):
+        with self.lock:
+            self.entries[os.path.realpath(filename)] = {
+                "identity": identity,
+                "digests": list(digests),
+                "used": time.time(),
+            }
+
+    def save(self):
+        """
+        Merge with what is on disk (other catsup processes may have saved
+        since we loaded), evict, and atomically replace the cache file
+        """
+        with self.lock:
+            entries = self.load()
+            for path, entry in self.entries.items():
+                if path not in entries or entries[path]["used"] < entry["used"]:
+                    entries[path] = entry
+            if len(entries) > self.max_entries:
+                oldest_first = sorted(entries, key=lambda x: entries[x]["used"])
+                for path in oldest_first[: len(entries) - self.max_entries]:
+                    del entries[path]
+            self.entries = entries
+            tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                f.write(json.dumps(entries))
+            os.replace(tmp, self.path)
+
+
+def new_hashers():
+    return [hashlib.md5(), hashlib.sha1(), hashlib.sha512()]
+
+
+def write_digests(filename, size, digests):
+    """
+    Write the sidecar digest file for filename
+    """
+    md5, sha1, sha512 = digests
+    with open(str(filename) + DIGEST_SUFFIX, "w") as f:
+        f.write(json.dumps({"size": size, "md5": md5, "sha1": sha1, "sha512": sha512}))
+
+
+def read_digests(filename, digest_dir):
+    """
+    Return the digests of filename from its sidecar in digest_dir, or
+    None if there is no sidecar or it was written for a different size
+    """
+    sidecar = pathlib.Path(digest_dir) / (pathlib.Path(filename).name + DIGEST_SUFFIX)
+    try:
+        with open(sidecar) as f:
+            data = json.loads(f.read())
+        if data["size"] != os.stat(filename).st_size:
+            return None
+        return data["md5"], data["sha1"], data["sha512"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def tee_digest(out_file, block_size=BLOCK_SIZE):
+    """
+    Copy stdin to out_file and write out_file.digests as the data goes by
+    """
+    hashers = new_hashers()
+    size = 0
+    stdin = sys.stdin.buffer
+    with open(out_file, "wb") as out:
+        while True:
+            block = stdin.read(block_size)
+            if not block:
+                break
+            out.write(block)
+            for h in hashers:
+                h.update(block)
+            size += len(block)
+    write_digests(out_file, size, [h.hexdigest() for h in hashers])
+
+
+def hash_file(filename, block_size=BLOCK_SIZE, cache=None, digest_dir=None):
+    """
+    Return the (md5, sha1, sha512) hex digests of filename
+    """
+    if digest_dir:
+        digests = read_digests(filename, digest_dir)
+        if digests:
+            return digests
+
+    if cache:
+        identity = cache.identity(filename)
+        digests = cache.get(filename, identity)
+        if digests:
+            return digests
+
+    hashers = new_hashers()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for h in hashers:
+                h.update(view[:n])
+    digests = tuple(h.hexdigest() for h in hashers)
+
+    if cache:
+        cache.put(filename, identity, digests)
+    return digests
+
+
+def hash_files(filenames, workers=1, cache=None, digest_dir=None):
+    """
+    Return the (md5, sha1, sha512) hex digests of filenames, in order
+
+    Up to workers files are hashed at the same time. hashlib releases the
+    GIL while digesting large blocks, so the threads run in parallel.
+    """
+
+    def hash_one(filename):
+        return hash_file(filename, cache=cache, digest_dir=digest_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        digests = list(pool.map(hash_one, filenames))
+    if cache:
+        cache.save()
+    return digests
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="File digests")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser("hash-file", help="print the digests of a file")
+    p.add_argument("filename")
+    p.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    p = commands.add_parser(
+        "tee-digest", help="copy stdin to a file and write its digests sidecar"
+    )
+    p.add_argument("out_file")
+    p.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "hash-file":
+        print("\n".join(hash_file(args.filename, args.block_size)))
+    elif args.command == "tee-digest":
+        tee_digest(args.out_file, args.block_size)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
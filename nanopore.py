@@ -5,56 +5,534 @@ by the human-removal pipeline.
 
 from pathlib import Path
 
-import shlex
+import collections
+import concurrent.futures
+import errno
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+
 import argh
 
+COPY_SIZE = 64 * 1024 * 1024
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+# a directory can change again within the same tick of a coarse mtime
+# (1s, or 2s on some network filesystems) without its mtime moving, so
+# a listing taken this soon after the last change isn't trusted
+MTIME_SLACK_NS = 2 * 1000 * 1000 * 1000
+
+# errors meaning that a kernel-side copy isn't possible between these files
+NO_KERNEL_COPY_ERRNOS = [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]
+
+KERNEL_COPIES = list()
+if hasattr(os, "copy_file_range"):
+    KERNEL_COPIES.append(lambda src, dst, n: os.copy_file_range(src, dst, n))
+if hasattr(os, "sendfile"):
+    KERNEL_COPIES.append(lambda src, dst, n: os.sendfile(dst, src, None, n))
+
+
+def scan_dir(directory: str, barcode=None):
+    """
+    List directory with one os.scandir pass
+
+    Return the time of the scan and the modification time of directory
+    (both read before listing it), its subdirectories and its files, each
+    file with its name, size, modification time, suffix and barcode
+    """
+    scanned_ns = int(time.time() * 1e9)
+    mtime_ns = os.stat(directory).st_mtime_ns
+    files = list()
+    subdirs = list()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                st = entry.stat()
+                files.append(
+                    {
+                        "name": entry.name,
+                        "size": st.st_size,
+                        "mtime": st.st_mtime,
+                        "suffix": os.path.splitext(entry.name)[1],
+                        "barcode": barcode,
+                    }
+                )
+    return {
+        "scanned_ns": scanned_ns,
+        "mtime_ns": mtime_ns,
+        "subdirs": sorted(subdirs),
+        "files": sorted(files, key=lambda x: x["name"]),
+    }
+
+
+class Inventory:
+    """
+    The files of a nanopore run directory and of its subdirectories (the
+    barcodes), listed with scan_dir
 
-def is_dir_gzipped(directory: str) -> bool:
+    refresh() only lists a directory again if its modification time has
+    changed, ie. if files were added, removed or renamed in it, or if it
+    was last listed within MTIME_SLACK_NS of its modification time, when
+    a change may not have moved it. refresh(full=True) lists every
+    directory. The inventory is saved in the submission so that it is
+    reused by later runs of step 1.5
+    """
+
+    def __init__(self, root, dirs=None):
+        self.root = str(root)
+        self.dirs = dirs or dict()
+
+    @classmethod
+    def load(cls, path, root):
+        try:
+            with open(path) as f:
+                data = json.loads(f.read())
+            if data["root"] == str(root):
+                return cls(root, data["dirs"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return cls(root)
+
+    def save(self, path):
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps({"root": self.root, "dirs": self.dirs}))
+        os.replace(tmp, path)
+
+    def refresh_dir(self, name, full=False):
+        directory = os.path.join(self.root, name)
+        cached = self.dirs.get(name)
+        if (
+            full
+            or not cached
+            or cached["mtime_ns"] != os.stat(directory).st_mtime_ns
+            or cached.get("scanned_ns", 0) - cached["mtime_ns"] < MTIME_SLACK_NS
+        ):
+            self.dirs[name] = scan_dir(directory, name or None)
+
+    def refresh(self, full=False):
+        self.refresh_dir("", full)
+        subdirs = self.dirs[""]["subdirs"]
+        for name in subdirs:
+            self.refresh_dir(name, full)
+        for name in list(self.dirs):
+            if name and name not in subdirs:
+                del self.dirs[name]
+        return self
+
+    def files(self, name=""):
+        """
+        Return the names of the files in the root directory or in its
+        subdirectory name
+        """
+        return [x["name"] for x in self.dirs[name]["files"]]
+
+    def subdirs(self):
+        return self.dirs[""]["subdirs"]
+
+
+def list_files(directory: str, files=None):
+    """
+    Return the paths of files (names) in directory, or of all the files
+    in directory, sorted by name
+    """
+    if files is None:
+        files = [x["name"] for x in scan_dir(directory)["files"]]
+    return [Path(directory) / x for x in sorted(files)]
+
+
+def is_dir_gzipped(directory: str, files=None) -> bool:
     """
     Check if the all the files in directory have a '.gz' extension
     """
-    files = Path(directory).glob("**")
+    files = list_files(directory, files)
     if not files:
         return False
-    files = filter(lambda x: x.is_file(), files)
     for f in files:
         if f.suffix != ".gz":
             return False
     return True
 
 
-def concat_files_cmd(directory: str, out_file: str):
+def kernel_copy(src, dst) -> bool:
+    """
+    Append the rest of file src to file dst without the data passing
+    through python, with copy_file_range or else sendfile
+
+    Return False if neither is possible for these files, before anything
+    has been copied
+    """
+    for copy in KERNEL_COPIES:
+        copied = 0
+        try:
+            while True:
+                n = copy(src.fileno(), dst.fileno(), COPY_SIZE)
+                if not n:
+                    return True
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in NO_KERNEL_COPY_ERRNOS:
+                raise
+    return False
+
+
+def read_blocks(files, block_size=GZIP_BLOCK_SIZE):
+    """
+    Yield the contents of files, one after the other, in blocks of
+    block_size bytes (the last one can be shorter)
+    """
+    block = bytearray()
+    for in_file in files:
+        with open(in_file, "rb") as f:
+            while True:
+                data = f.read(block_size - len(block))
+                if not data:
+                    break
+                block += data
+                if len(block) == block_size:
+                    yield bytes(block)
+                    block = bytearray()
+    if block:
+        yield bytes(block)
+
+
+def gzip_block(data: bytes, level: int) -> bytes:
+    """
+    Compress data into a complete gzip member
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_files(files, out, level=6, threads=1, block_size=GZIP_BLOCK_SIZE):
     """
-    Return the commands to concat files in directory into out_file
+    Compress files into the open file out, as one gzip member per block
+
+    The blocks are compressed by threads threads (zlib releases the GIL)
+    and written in order. Any gzip reader decompresses the members as one
+    stream.
     """
-    files = Path(directory).glob("*")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        pending = collections.deque()
+        for block in read_blocks(files, block_size):
+            pending.append(pool.submit(gzip_block, block, level))
+            # keep memory bounded when compression is slower than reading
+            if len(pending) >= 2 * max(1, threads):
+                out.write(pending.popleft().result())
+        while pending:
+            out.write(pending.popleft().result())
+
+
+def concat_files(
+    directory: str, out_file: str, gzip_level=6, gzip_threads=1, files=None
+):
+    """
+    Concatenate the files in directory (or only files, a list of names)
+    into the gzip file out_file
+
+    Gzipped files are appended as they are, since a gzip file can hold
+    many members. Other files are compressed with gzip_files.
+
+    Return None on success, or a dict describing the error
+    """
+    files = list_files(directory, files)
     if not files:
-        return False
-    files = filter(lambda x: x.is_file(), files)
-    files = map(str, files)
-    cmds = list()
-    if is_dir_gzipped(directory):
-        for f in files:
-            cmds.append(f"cat {shlex.quote(f)} >> {shlex.quote(out_file)}")
-    else:
-        for f in files:
-            cmds.append(f"cat {shlex.quote(f)} | gzip -c >> {shlex.quote(out_file)}")
-    return cmds
+        return {"reason": "no_files", "directory": str(directory)}
+    in_file = None
+    try:
+        with open(out_file, "wb", buffering=0) as out:
+            if not is_dir_gzipped(directory, [x.name for x in files]):
+                gzip_files(files, out, gzip_level, gzip_threads)
+            else:
+                for in_file in files:
+                    with open(in_file, "rb", buffering=0) as f:
+                        if not kernel_copy(f, out):
+                            shutil.copyfileobj(f, out, COPY_SIZE)
+    except OSError as e:
+        return {
+            "reason": "concat_failed",
+            "in_file": str(e.filename or in_file),
+            "out_file": str(out_file),
+            "python_exception": str(e),
+        }
+    return None
+
+
+def symlink_file(in_file: str, out_file: str):
+    """
+    Symlink in_file to out_file. Return None on success, or a dict
+    describing the error
+    """
+    try:
+        os.symlink(in_file, out_file)
+    except FileExistsError:
+        if os.path.realpath(out_file) != os.path.realpath(in_file):
+            return {"reason": "file_exists", "out_file": str(out_file)}
+    except OSError as e:
+        return {
+            "reason": "symlink_failed",
+            "in_file": str(in_file),
+            "out_file": str(out_file),
+            "python_exception": str(e),
+        }
+    return None
+
+
+def run_job(job, gzip_level=6, gzip_threads=1):
+    """
+    Run a job returned by one of the nanopore_*_preprocess functions.
+    Return None on success, or a dict describing the error
+    """
+    if job["action"] == "concat":
+        return concat_files(
+            job["input"], job["output"], gzip_level, gzip_threads, job.get("files")
+        )
+    if job["action"] == "symlink":
+        return symlink_file(job["input"], job["output"])
+    return {"reason": "unknown_action", "action": job["action"]}
+
+
+def run_jobs(
+    jobs, workers=1, report=None, gzip_level=6, gzip_threads=1, ledger=None
+):
+    """
+    Run jobs, up to workers at a time. Uncompressed input is compressed
+    at gzip_level with gzip_threads threads per job
+
+    report(status) is called with the state (queued, running, done or
+    failed) of every job, by output file name, whenever one changes. If
+    a ChunkLedger is given, the outputs that concat jobs rewrite are
+    recorded in it, so that following the run later appends to them
+    correctly. Return the errors of the jobs that failed, by output file
+    name
+    """
+    lock = threading.Lock()
+    status = {Path(job["output"]).name: "queued" for job in jobs}
+    errors = dict()
+
+    def update(name, state):
+        with lock:
+            status[name] = state
+            if report:
+                report(dict(status))
+
+    def run_one(job):
+        name = Path(job["output"]).name
+        update(name, "running")
+        concat = ledger and job["action"] == "concat"
+        if concat:
+            ledger.reset(job["output"])
+        error = run_job(job, gzip_level, gzip_threads)
+        if error:
+            errors[name] = error
+        elif concat:
+            chunks = list_files(job["input"], job.get("files"))
+            length = os.path.getsize(job["output"])
+            ledger.commit(job["output"], [x.name for x in chunks], length)
+        update(name, "failed" if error else "done")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(run_one, jobs))
+    return errors
+
+
+class ChunkLedger:
+    """
+    Record, for every output file, the input chunks appended to it and its
+    length after the last complete append, so that following a run that
+    is still being sequenced never appends a chunk twice
+    """
 
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.outputs = json.loads(f.read())
+        except (OSError, ValueError):
+            self.outputs = dict()
 
-def nanopore_notmultiplexed_preprocess(input_dir: str, output_dir: str):
+    def get(self, output):
+        with self.lock:
+            entry = self.outputs.get(Path(output).name, {"length": 0, "chunks": []})
+            return {"length": entry["length"], "chunks": list(entry["chunks"])}
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps(self.outputs))
+        os.replace(tmp, self.path)
+
+    def commit(self, output, chunks, length):
+        with self.lock:
+            entry = self.outputs.setdefault(
+                Path(output).name, {"length": 0, "chunks": []}
+            )
+            entry["chunks"].extend(chunks)
+            entry["length"] = length
+            self.save()
+
+    def reset(self, output):
+        """
+        Forget the chunks of output, which is about to be written from
+        the start
+        """
+        with self.lock:
+            if self.outputs.pop(Path(output).name, None) is not None:
+                self.save()
+
+
+def append_chunks(job, ledger, settle=60, gzip_level=6, gzip_threads=1):
+    """
+    Append the files in job["input"] that aren't in the ledger yet, and
+    haven't been modified for settle seconds, to job["output"]
+
+    Gzipped chunks are appended as they are, others are compressed.
+    Return the number of chunks appended
+    """
+    entry = ledger.get(job["output"])
+    done = set(entry["chunks"])
+    now = time.time()
+    chunks = [
+        x
+        for x in list_files(job["input"], job.get("files"))
+        if x.name not in done and now - x.stat().st_mtime >= settle
+    ]
+    if not chunks:
+        return 0
+    # not in append mode, which copy_file_range refuses
+    mode = "r+b" if os.path.exists(job["output"]) else "wb"
+    with open(job["output"], mode, buffering=0) as out:
+        # drop whatever an interrupted append left after the last commit
+        out.truncate(entry["length"])
+        out.seek(entry["length"])
+        for chunk in chunks:
+            if chunk.suffix == ".gz":
+                with open(chunk, "rb", buffering=0) as f:
+                    if not kernel_copy(f, out):
+                        shutil.copyfileobj(f, out, COPY_SIZE)
+            else:
+                gzip_files([chunk], out, gzip_level, gzip_threads)
+        os.fsync(out.fileno())
+        length = out.tell()
+    ledger.commit(job["output"], [x.name for x in chunks], length)
+    return len(chunks)
+
+
+def is_run_finished(input_dir: str) -> bool:
+    """
+    MinKNOW writes final_summary_*.txt into the run directory, above
+    fastq_pass, when the run ends
     """
-    Return list of list of commands to execute to bring a
-    non-multiplexed (single sample) nanopore run into a format
-    that can be accepted by the preprocessing pipeline
+    for directory in [Path(input_dir), Path(input_dir).parent]:
+        if list(directory.glob("final_summary_*.txt")):
+            return True
+    return False
+
+
+def follow_run(
+    make_jobs,
+    input_dir,
+    ledger,
+    interval=60,
+    idle_timeout=3600,
+    workers=1,
+    report=None,
+    gzip_level=6,
+    gzip_threads=1,
+):
+    """
+    Append new chunks to the outputs of the concat jobs from
+    make_jobs(final) every interval seconds, until the run has finished
+    or no new chunk has appeared for idle_timeout seconds. make_jobs is
+    called on every pass, since new barcode directories appear during the
+    run. final is True in the last pass, when make_jobs should list the
+    run directory in full, so that no chunk is missed
+
+    A chunk is only appended once it hasn't changed for interval seconds,
+    except in the last pass. report(status) is called after every pass
+    with the number of chunks appended to each output. Return the errors
+    of the jobs that failed, by output file name
+    """
+    last_chunk = time.monotonic()
+    counts = collections.Counter()
+    while True:
+        finished = (
+            is_run_finished(input_dir) or time.monotonic() - last_chunk > idle_timeout
+        )
+        jobs = make_jobs(finished) or list()
+        errors = dict()
+
+        def append_one(job):
+            name = Path(job["output"]).name
+            try:
+                n = append_chunks(
+                    job, ledger, 0 if finished else interval, gzip_level, gzip_threads
+                )
+            except OSError as e:
+                errors[name] = {
+                    "reason": "append_failed",
+                    "out_file": job["output"],
+                    "python_exception": str(e),
+                }
+                return 0
+            counts[name] += n
+            return n
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, workers)
+        ) as pool:
+            appended = sum(pool.map(append_one, jobs))
+        if appended:
+            last_chunk = time.monotonic()
+        if report:
+            status = dict()
+            for job in jobs:
+                name = Path(job["output"]).name
+                if name in errors:
+                    status[name] = "failed"
+                elif finished:
+                    status[name] = "done"
+                else:
+                    status[name] = f"{counts[name]} chunks"
+            report(status)
+        if errors:
+            return errors
+        if finished:
+            return dict()
+        time.sleep(interval)
+
+
+def nanopore_notmultiplexed_preprocess(
+    input_dir: str, output_dir: str, inventory=None
+):
+    """
+    Return the jobs (see run_job) that bring a non-multiplexed (single
+    sample) nanopore run into a format that can be accepted by the
+    preprocessing pipeline
+
+    inventory is the refreshed Inventory of input_dir, if there is one
     """
     input_dir = Path(input_dir)
     if not input_dir.is_dir():
         return False
+    inventory = inventory or Inventory(input_dir).refresh()
     extension = ".fastq.gz"
     output_file = str(Path(output_dir) / ("nanopore_sample" + extension))
-    cmds = [concat_files_cmd(input_dir, output_file)]
-    return cmds
+    return [
+        {
+            "action": "concat",
+            "input": str(input_dir),
+            "output": output_file,
+            "files": inventory.files(),
+        }
+    ]
 
 
 # single dir not multiplexed gzipped:
@@ -63,62 +541,79 @@ def nanopore_notmultiplexed_preprocess(input_dir: str, output_dir: str):
 # /media/grid0/DFB_R_15/no_sample/20210525_1816_X5_FAP94036_c8c034c5/fastq_pass/
 
 
-def nanopore_multiplexed_preprocess(input_dir: str, output_dir: str):
+def nanopore_multiplexed_preprocess(input_dir: str, output_dir: str, inventory=None):
     """
-    Return list of list of commands to execute to bring a
-    multiplexed (many samples) nanopore run into a format
-    that can be accepted by the preprocessing pipeline
+    Return the jobs (see run_job) that bring a multiplexed (many
+    samples) nanopore run into a format that can be accepted by the
+    preprocessing pipeline
 
     This assumes that the barcode directories start with
-    "barcode"
+    "barcode". Empty barcode directories, which MinKNOW can leave behind,
+    get no job. inventory is the refreshed Inventory of input_dir, if
+    there is one
     """
     input_dir = Path(input_dir)
     if not input_dir.is_dir():
         return False
+    inventory = inventory or Inventory(input_dir).refresh()
 
-    cmds = list()
-    for barcode_dir in input_dir.glob("*"):
-        if not barcode_dir.is_dir():
+    jobs = list()
+    for barcode in inventory.subdirs():
+        if barcode[0:7] != "barcode":
             continue
-        if str(barcode_dir.name)[0:7] != "barcode":
+        if not inventory.files(barcode):
             continue
 
         extension = ".fastq.gz"
 
-        output_file = str(Path(output_dir) / barcode_dir.name) + extension
-        cmds.append(concat_files_cmd(barcode_dir, output_file))
+        output_file = str(Path(output_dir) / barcode) + extension
+        jobs.append(
+            {
+                "action": "concat",
+                "input": str(input_dir / barcode),
+                "output": output_file,
+                "files": inventory.files(barcode),
+            }
+        )
 
-    return cmds
+    return jobs
 
 
-def nanopore_dirfiles_preprocess(input_dir: str, output_dir: str):
+def nanopore_dirfiles_preprocess(input_dir: str, output_dir: str, inventory=None):
     """
     Symlink dir of nanopore files into nanomerge dir.
 
-    Return list of list of commands to execute to bring a directory
-    of nanopore files (many samples) into the correct format.
+    Return the jobs (see run_job) that bring a directory of nanopore
+    files (many samples) into the correct format.
 
     The format is actually already correct (directory of fastqs),
-    so this just symlinks the files.
+    so this just symlinks the files. inventory is the refreshed
+    Inventory of input_dir, if there is one
     """
     input_dir = Path(input_dir)
     if not input_dir.is_dir():
         return False
+    inventory = inventory or Inventory(input_dir).refresh()
 
-    cmds = list()
-    for input_file in input_dir.glob("*"):
+    jobs = list()
+    for input_file in list_files(input_dir, inventory.files()):
         output_file = Path(output_dir) / input_file.name
-        cmd = f"ln -s {shlex.quote(str(input_file))} {shlex.quote(str(output_file))}"
-        cmds.append(cmd)
+        jobs.append(
+            {
+                "action": "symlink",
+                "input": str(input_file),
+                "output": str(output_file),
+            }
+        )
 
-    return [cmds]
+    return jobs
 
 
 if __name__ == "__main__":
     argh.dispatch_commands(
         [
             is_dir_gzipped,
-            concat_files_cmd,
+            concat_files,
             nanopore_multiplexed_preprocess,
             nanopore_notmultiplexed_preprocess,
         ]
@@ -1,55 +1,550 @@
+import collections
+import concurrent.futures
 import csv
+import http.client
+import json
+import math
 import os
 import pathlib
-import subprocess
-import shlex
-import time
+import threading
+import urllib.parse
 
 import argh
 
+import hashing
+import retry
+import throttle
 
-def run(cmd, trace=True):
+BLOCK_SIZE = 1024 * 1024
+MULTIPART_THRESHOLD = 128 * 1024 * 1024
+PART_SIZE = 64 * 1024 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive connections, by scheme and host, shared by all uploads
+    in the process so that each PUT doesn't pay for a new TLS handshake
+    """
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+
+    def acquire(self, scheme, netloc):
+        """
+        return (connection, reused)
+        """
+        with self.lock:
+            if self.idle[(scheme, netloc)]:
+                return self.idle[(scheme, netloc)].pop(), True
+        return self.connect(scheme, netloc), False
+
+    def connect(self, scheme, netloc):
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            self.idle[(scheme, netloc)].append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+POOL = ConnectionPool()
+
+
+def send_request(
+    conn, method, path, headers, body, body_file, body_length, on_send=None
+):
+    # signed requests (see s3.py) bring their own Host header
+    conn.putrequest(
+        method, path, skip_host="Host" in headers, skip_accept_encoding=True
+    )
+    conn.putheader("Content-Length", str(body_length))
+    for k, v in headers.items():
+        conn.putheader(k, v)
+    conn.endheaders()
+    if body_file:
+        remaining = body_length
+        while remaining:
+            block = body_file.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise UploadError(f"{body_file.name} is shorter than expected")
+            if on_send:
+                on_send(len(block))
+            conn.send(block)
+            remaining -= len(block)
+    elif body:
+        conn.send(body)
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def http_request(
+    method,
+    url,
+    body=b"",
+    body_file=None,
+    body_length=None,
+    headers=None,
+    pool=POOL,
+    on_send=None,
+    on_progress=None,
+):
+    """
+    Send a request over a pooled connection and return (status, headers, data)
+
+    If body_file is given, body_length bytes are streamed from its current
+    position instead of sending body, and on_send(n) is called before
+    each block of n bytes is sent. on_progress(n) is called the same way,
+    except that a body sent again after a stale connection is only
+    reported to it once.
+    """
+    u = urllib.parse.urlsplit(url)
+    path = u.path + ("?" + u.query if u.query else "")
+    headers = headers or dict()
+    if not body_file:
+        body_length = len(body)
+    start = body_file.tell() if body_file else None
+
+    # bytes sent again on a fresh connection were already reported by the
+    # attempt that failed, so on_progress only hears about the ones past
+    # them. on_send (the throttle) is told about every byte sent
+    reported = 0
+    attempt_sent = 0
+
+    def count(n):
+        nonlocal reported, attempt_sent
+        if on_send:
+            on_send(n)
+        attempt_sent += n
+        if on_progress and attempt_sent > reported:
+            on_progress(attempt_sent - reported)
+            reported = attempt_sent
+
+    conn, reused = pool.acquire(u.scheme, u.netloc)
+    try:
+        response, data = send_request(
+            conn, method, path, headers, body, body_file, body_length, count
+        )
+    except (http.client.RemoteDisconnected, ConnectionError):
+        conn.close()
+        if not reused:
+            raise
+        # the server closed an idle connection. try once more on a new one
+        if body_file:
+            body_file.seek(start)
+        attempt_sent = 0
+        conn = pool.connect(u.scheme, u.netloc)
+        try:
+            response, data = send_request(
+                conn, method, path, headers, body, body_file, body_length, count
+            )
+        except Exception:
+            conn.close()
+            raise
+    except Exception:
+        conn.close()
+        raise
+
+    if response.will_close:
+        conn.close()
+    else:
+        pool.release(u.scheme, u.netloc, conn)
+
+    if response.status >= 400:
+        raise UploadError(
+            f"{method} {url} returned HTTP {response.status} {response.reason}",
+            response.status,
+        )
+    return response.status, dict(response.getheaders()), data
+
+
+def put_file(url, u_file, on_send=None, on_progress=None):
+    with open(u_file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        http_request(
+            "PUT",
+            url,
+            body_file=f,
+            body_length=size,
+            on_send=on_send,
+            on_progress=on_progress,
+        )
+
+
+def load_multipart_state(state_file, u_file, part_size):
+    """
+    Return the recorded state of a multipart upload of u_file, or a new
+    state if there is none or the file has changed since it was recorded
+    """
+    st = os.stat(u_file)
+    identity = [st.st_size, st.st_mtime_ns, part_size]
+    state = None
+    try:
+        with open(state_file) as f:
+            state = json.loads(f.read())
+        if [state["size"], state["mtime_ns"], state["part_size"]] == identity:
+            return state
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "part_size": part_size,
+        "access_uri": None,
+        "parts": [],
+        "stale_access_uri": state.get("access_uri") if type(state) == dict else None,
+    }
+
+
+def save_multipart_state(state_file, state):
+    state_file = pathlib.Path(state_file)
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = state_file.with_name(state_file.name + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(json.dumps(state))
+    os.replace(tmp, state_file)
+
+
+def remove_multipart_state(state_file):
+    try:
+        pathlib.Path(state_file).unlink()
+    except FileNotFoundError:
+        # the upload failed before any state was saved
+        pass
+
+
+def put_file_multipart(
+    url, u_file, state_file, part_size=PART_SIZE, on_send=None, on_progress=None
+):
+    """
+    Upload u_file in parts with an object storage PAR multipart upload
+
+    Finished parts are recorded in state_file, so a retry (or a new
+    process) only sends the parts that are missing.
+    """
+    u = urllib.parse.urlsplit(url)
+    state = load_multipart_state(state_file, u_file, part_size)
+    stale_access_uri = state.pop("stale_access_uri", None)
+    if stale_access_uri:
+        # the file changed under an unfinished upload. abort it
+        try:
+            http_request("DELETE", f"{u.scheme}://{u.netloc}{stale_access_uri}")
+        except Exception:
+            pass
+
+    try:
+        if not state["access_uri"]:
+            _, _, data = http_request("PUT", url, headers={"opc-multipart": "true"})
+            state["access_uri"] = json.loads(data.decode())["accessUri"]
+            save_multipart_state(state_file, state)
+        upload_url = f"{u.scheme}://{u.netloc}{state['access_uri']}"
+
+        size = state["size"]
+        with open(u_file, "rb") as f:
+            for part_num in range(1, max(1, math.ceil(size / part_size)) + 1):
+                if part_num in state["parts"]:
+                    continue
+                offset = (part_num - 1) * part_size
+                f.seek(offset)
+                http_request(
+                    "PUT",
+                    f"{upload_url}{part_num}",
+                    body_file=f,
+                    body_length=min(part_size, size - offset),
+                    on_send=on_send,
+                    on_progress=on_progress,
+                )
+                state["parts"].append(part_num)
+                save_multipart_state(state_file, state)
+
+        http_request("POST", upload_url)
+    except UploadError as e:
+        if e.status == 404:
+            # the multipart upload expired or was aborted. start again next time
+            remove_multipart_state(state_file)
+        raise
+
+    remove_multipart_state(state_file)
+
+
+class UploadJournal:
+    """
+    Per-submission record of the files that have landed at a destination
+
+    A file is skipped on a later run if it was uploaded to the same
+    destination with the same size and md5. The md5 of the clean files is
+    taken from sp3data.csv, other files are hashed.
+    """
+
+    def __init__(self, path, destination, known_md5s=None):
+        self.path = pathlib.Path(path)
+        self.destination = destination
+        self.known_md5s = known_md5s or dict()
+        self.lock = threading.Lock()
+        self.files = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.loads(f.read())
+            if data["destination"] == self.destination:
+                return data["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return dict()
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(
+                json.dumps(
+                    {"destination": self.destination, "files": self.files}, indent=4
+                )
+            )
+        os.replace(tmp, self.path)
+
+    def md5(self, u_file):
+        u_file = pathlib.Path(u_file)
+        if u_file.name in self.known_md5s:
+            return self.known_md5s[u_file.name]
+        return hashing.hash_file(u_file)[0]
+
+    def is_done(self, u_file):
+        with self.lock:
+            entry = self.files.get(pathlib.Path(u_file).name)
+        if not entry or entry["state"] != "done":
+            return False
+        if entry["size"] != pathlib.Path(u_file).stat().st_size:
+            return False
+        return entry["md5"] == self.md5(u_file)
+
+    def record(self, u_file, state):
+        if os.environ.get("DUMMY_RUN"):
+            return
+        u_file = pathlib.Path(u_file)
+        entry = {"size": u_file.stat().st_size, "md5": self.md5(u_file), "state": state}
+        with self.lock:
+            self.files[u_file.name] = entry
+            self.save()
+
+
+def open_journal(u_dir, destination):
+    """
+    Return the upload journal of the submission that u_dir belongs to
+    """
+    u_dir = pathlib.Path(u_dir)
+    known_md5s = dict()
+    try:
+        with open(u_dir / "sp3data.csv") as f:
+            for row in csv.DictReader(f):
+                if row.get("clean_file_md5"):
+                    known_md5s[row["sample_filename"]] = row["clean_file_md5"]
+    except OSError:
+        pass
+    return UploadJournal(
+        u_dir.absolute().parent / "upload_journal.json", destination, known_md5s
+    )
+
+
+POLICY = retry.RetryPolicy()
+
+
+def retryable(e):
+    """
+    Client errors won't go away by trying again. The exceptions are
+    expired multipart uploads (404, restarted on the next attempt),
+    timeouts and throttling
+    """
+    if isinstance(e, UploadError) and e.status:
+        return e.status >= 500 or e.status in [404, 408, 429]
+    return True
+
+
+def run(cmd, fn, trace=True, policy=None, deadline=None, breaker=None):
+    """
+    Call fn until it succeeds or the retry policy gives up
+
+    cmd describes the call in logs and in the returned error dict, which
+    also lists every attempt
+    """
     if not os.environ.get("NO_TRACE") or not trace:
         print(cmd)
     if not os.environ.get("DUMMY_RUN"):
-        attempt = 0
-        while True:
-            attempt += 1
-            try:
-                subprocess.check_output(shlex.split(cmd))
-                break
-            except Exception as e:
-                if attempt > 12:
-                    return {
-                        "error_command": cmd,
-                        "error_exception_str": str(e),
-                    }
-                else:
-                    print(f"Error in upload. Attempt {attempt}. Sleeping for {2 ** attempt} seconds")
-                    time.sleep(2 ** attempt)
-
-
-def upload_file(par_url, u_file, cloud_prefix):
+        attempts = retry.call(fn, policy or POLICY, deadline, breaker, retryable)
+        if attempts:
+            return {
+                "error_command": cmd,
+                "error_exception_str": attempts[-1]["error"],
+                "attempts": attempts,
+            }
+
+
+def object_url(par_url, cloud_prefix, name):
+    return f"{par_url}{cloud_prefix}/{urllib.parse.quote(name)}"
+
+
+def upload_file(
+    par_url,
+    u_file,
+    cloud_prefix,
+    multipart_threshold=MULTIPART_THRESHOLD,
+    part_size=PART_SIZE,
+    policy=None,
+    deadline=None,
+    progress=None,
+):
+    """
+    Upload u_file to par_url. Files larger than multipart_threshold are
+    uploaded in parts, recording progress in .par_multipart/ next to the
+    upload directory. Bytes sent are counted in progress, if given
+    """
     u_file = pathlib.Path(u_file)
-    cmd  = f"curl -f -X PUT -T {u_file} {par_url}{cloud_prefix}/{u_file.name}"
-    error = run(cmd)
+    url = object_url(par_url, cloud_prefix, u_file.name)
+    policy = policy or POLICY
+    breaker = policy.breaker(urllib.parse.urlsplit(url).netloc)
+
+    def on_send(n):
+        throttle.LIMITER.consume(cloud_prefix, n)
+
+    def on_progress(n):
+        if progress:
+            progress.add(u_file.name, n)
+
+    if u_file.stat().st_size > multipart_threshold:
+        state_file = (
+            u_file.absolute().parent.parent / ".par_multipart" / f"{u_file.name}.json"
+        )
+        error = run(
+            f"PUT {u_file} {url} (multipart)",
+            lambda: put_file_multipart(
+                url, u_file, state_file, part_size, on_send, on_progress
+            ),
+            policy=policy,
+            deadline=deadline,
+            breaker=breaker,
+        )
+    else:
+        error = run(
+            f"PUT {u_file} {url}",
+            lambda: put_file(url, u_file, on_send, on_progress),
+            policy=policy,
+            deadline=deadline,
+            breaker=breaker,
+        )
     return error
 
 
-def mark_finished(par_url, u_dir, cloud_prefix):
+def mark_finished(par_url, u_dir, cloud_prefix, policy=None, deadline=None):
     u_file = pathlib.Path(u_dir) / "upload_done.txt"
     u_file.touch()
-    cmd = f"curl -f -X PUT --data-binary '@{u_file}' {par_url}{cloud_prefix}/{u_file.name}"
-    error = run(cmd)
-    return error
+    return upload_file(par_url, u_file, cloud_prefix, policy=policy, deadline=deadline)
+
+
+def upload_files(u_files, journal, upload_fn, workers, throttle_key, progress=None):
+    """
+    Call upload_fn(u_file) for every file, up to workers files at a time,
+    and record the outcome of each in the journal and in progress
+
+    Return None if every file succeeded. Otherwise return an error dict
+    with the first failure's keys and the errors of every failed file
+    under failed_files
+    """
 
+    def upload_one(u_file):
+        journal.record(u_file, "uploading")
+        if progress:
+            progress.start_file(u_file.name)
+        error = upload_fn(u_file)
+        journal.record(u_file, "failed" if error else "done")
+        if progress:
+            progress.finish_file(u_file.name, not error)
+        return error
 
-def upload_dir(par_url, u_dir, cloud_prefix):
-    for u_file in pathlib.Path(u_dir).glob("*"):
-        error = upload_file(par_url, u_file, cloud_prefix)
-        if error:
-            return error
-    return mark_finished(par_url, u_dir, cloud_prefix)
+    if progress:
+        for u_file in u_files:
+            progress.add_file(u_file.name, u_file.stat().st_size)
+
+    with throttle.LIMITER.activate(throttle_key):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            errors = pool.map(upload_one, u_files)
+            failed_files = {
+                u_file.name: error for u_file, error in zip(u_files, errors) if error
+            }
+    if failed_files:
+        error = dict(next(iter(failed_files.values())))
+        error["failed_files"] = failed_files
+        return error
+    return None
+
+
+def upload_dir(
+    par_url,
+    u_dir,
+    cloud_prefix,
+    workers=1,
+    multipart_threshold=MULTIPART_THRESHOLD,
+    part_size=PART_SIZE,
+    policy=None,
+    progress=None,
+):
+    """
+    Upload every file in u_dir, up to workers files at a time, and then
+    upload_done.txt once all of them have succeeded
+
+    Files that the submission's upload journal shows as already uploaded
+    are skipped. No new attempts are started after the policy's
+    submission_deadline.
+
+    On failure, the returned error dict has the first failure's keys and
+    the errors of every failed file under failed_files
+    """
+    policy = policy or POLICY
+    deadline = retry.Deadline(policy.submission_deadline)
+    journal = open_journal(u_dir, f"{par_url}{cloud_prefix}")
+    u_files = sorted(
+        x
+        for x in pathlib.Path(u_dir).glob("*")
+        if x.name != "upload_done.txt" and not journal.is_done(x)
+    )
+
+    def upload_fn(u_file):
+        return upload_file(
+            par_url,
+            u_file,
+            cloud_prefix,
+            multipart_threshold,
+            part_size,
+            policy,
+            deadline,
+            progress,
+        )
+
+    error = upload_files(u_files, journal, upload_fn, workers, cloud_prefix, progress)
+    if error:
+        return error
+
+    marker = pathlib.Path(u_dir) / "upload_done.txt"
+    if not u_files and marker.exists() and journal.is_done(marker):
+        return None
+    error = mark_finished(par_url, u_dir, cloud_prefix, policy, deadline)
+    if not error:
+        journal.record(marker, "done")
+    return error
 
 
 def get_submission_name_from_sp3data_csv(u_dir):
@@ -61,10 +556,27 @@ def get_submission_name_from_sp3data_csv(u_dir):
             return submission_uuid4
 
 
-def upload_run(par_url, u_dir):
+def upload_run(
+    par_url,
+    u_dir,
+    workers=1,
+    multipart_threshold=MULTIPART_THRESHOLD,
+    part_size=PART_SIZE,
+    policy=None,
+    progress=None,
+):
     u_dir = pathlib.Path(u_dir) / "upload"
     submission_uuid4 = get_submission_name_from_sp3data_csv(u_dir)
-    error = upload_dir(par_url, u_dir, submission_uuid4)
+    error = upload_dir(
+        par_url,
+        u_dir,
+        submission_uuid4,
+        workers,
+        multipart_threshold,
+        part_size,
+        policy,
+        progress,
+    )
     return error
 
 
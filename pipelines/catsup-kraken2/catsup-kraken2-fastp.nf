@@ -24,6 +24,9 @@
 
 */
 
+params.catsup_dir = "${baseDir}/../.."
+params.digest_dir = "${params.output_dir}/../upload_digests"
+
 /*
  * Display information before the run
 */
@@ -39,6 +42,7 @@ SP3 catsup-kraken2-fastp nextflow pipeline
 --db            $params.db
 --paired        $params.paired
 --output_dir    $params.output_dir
+--digest_dir    $params.digest_dir
 ************************************
 """
 log.info "                         "
@@ -51,6 +55,15 @@ input_dir = params.input_dir
 read_pattern = params.read_pattern
 db = file(params.db)
 output_dir = params.output_dir
+digest_dir = params.digest_dir
+catsup_dir = params.catsup_dir
+
+// catsup's own scripts are staged into the tasks that run them, so that
+// they are visible inside the container
+if (!file("${catsup_dir}/fastq.py").exists())
+    exit 1, "catsup scripts not found in ${catsup_dir}, set --catsup_dir"
+classification_py = Channel.value(file("${catsup_dir}/classification.py"))
+removal_py = Channel.value(files("${catsup_dir}/{fastq,readset,hashing}.py"))
 paired = params.paired
 if (paired == true)
     Channel.fromFilePairs(input_dir + read_pattern, flat:true).set { fqs_paired }
@@ -190,35 +203,19 @@ if (paired == true){
 
         input:
         set val(dataset_id), read1, read2 from trim_out
+        file(classification_script) from classification_py
 
         output:
-        set val(dataset_id), read1, read2, file("${dataset_id}.classification_non_human_read_list.txt"), file("${dataset_id}.classification_human_read_list.txt") into non_human_list
+        set val(dataset_id), read1, read2, file("${dataset_id}.classification_human_read_list.txt") into human_list
 
         script:
         kraken2_summary              = "${dataset_id}.species_classification.txt"
         kraken2_read_classification  = "${dataset_id}.read_classification.txt"
         kraken2_human_read_list      = "${dataset_id}.classification_human_read_list.txt"
-        kraken2_non_human_read_list  = "${dataset_id}.classification_non_human_read_list.txt"
         """
-        cat <<- EOF >> filter.py
-        import sys
-
-        filename = sys.argv[1]
-
-        tbl1 = open(filename).readlines()
-        tbl1 = [x.split('\t') for x in tbl1]
-
-        #
-        # write non-human read ids
-        #
-        human_id = '9606'
-
-        for row in tbl1:
-            if row[2] != human_id:
-                print(row[1])
-        EOF
+        set -o pipefail
 
-        kraken2 -db ${db} --report ${kraken2_summary} --output ${kraken2_read_classification} --paired ${read1} ${read2}
+        kraken2 -db ${db} --threads ${task.cpus} --report ${kraken2_summary} --output ${kraken2_read_classification} --paired ${read1} ${read2}
 
         echo "==== kraken2 ====" > ${kraken2_human_read_list}
 
@@ -227,8 +224,7 @@ if (paired == true){
         fi
 
         echo "==== human reads ====" >> ${kraken2_human_read_list}
-        awk '\$3==\"9606\" { print \$2 }' ${kraken2_read_classification} >> ${kraken2_human_read_list}
-        python3 filter.py ${kraken2_read_classification} > ${kraken2_non_human_read_list}
+        python3 classification.py split ${kraken2_read_classification} ${kraken2_human_read_list}
 
         """
     }
@@ -244,36 +240,20 @@ else{
 
     input:
     set dataset_id, read1 from trim_out
+    file(classification_script) from classification_py
 
     output:
-    set dataset_id, read1, file("${dataset_id}.classification_non_human_read_list.txt"), file("${dataset_id}.classification_human_read_list.txt") into non_human_list
+    set dataset_id, read1, file("${dataset_id}.classification_human_read_list.txt") into human_list
 
     script:
     kraken2_summary              = "${dataset_id}.species_classification.txt"
     kraken2_read_classification  = "${dataset_id}.read_classification.txt"
     kraken2_human_read_list      = "${dataset_id}.classification_human_read_list.txt"
-    kraken2_non_human_read_list  = "${dataset_id}.classification_non_human_read_list.txt"
 
     """
-    cat <<- EOF >> filter.py
-    import sys
+    set -o pipefail
 
-    filename = sys.argv[1]
-
-    tbl1 = open(filename).readlines()
-    tbl1 = [x.split('\t') for x in tbl1]
-
-    #
-    # write non-human read ids
-    #
-    human_id = '9606'
-
-    for row in tbl1:
-        if row[2] != human_id:
-            print(row[1])
-    EOF
-
-    kraken2 -db ${db} --report ${kraken2_summary} --output ${kraken2_read_classification} ${read1}
+    kraken2 -db ${db} --threads ${task.cpus} --report ${kraken2_summary} --output ${kraken2_read_classification} ${read1}
 
     echo "==== kraken2 ====" > ${kraken2_human_read_list}
 
@@ -282,8 +262,7 @@ else{
     fi
 
     echo "==== human reads ====" >> ${kraken2_human_read_list}
-    awk '\$3==\"9606\" { print \$2 }' ${kraken2_read_classification} >> ${kraken2_human_read_list}
-    python3 filter.py ${kraken2_read_classification} > ${kraken2_non_human_read_list}
+    python3 classification.py split ${kraken2_read_classification} ${kraken2_human_read_list}
 
     """
     }
@@ -291,51 +270,38 @@ else{
 
 /***********
 * PART 3: Remove human reads
-* seqtk subseq ${dataset_id}_1.fix ${nonhm} | gzip > "${dataset_id}_C1.fastq.gz"
-* seqtk subseq ${dataset_id}_2.fix ${nonhm} | gzip > "${dataset_id}_C2.fastq.gz"
+* zcat ${read1} | fastq.py filter --exclude ${hum} | gzip > "${dataset_id}_C1.fastq.gz"
+* zcat ${read2} | fastq.py filter --exclude ${hum} | gzip > "${dataset_id}_C2.fastq.gz"
+*
+* fastq.py filter removes /1 and /2 from the read headers and drops the
+* reads in the human read list in one pass, without temporary files.
+*
+* The clean files are written through hashing.py tee-digest, which leaves
+* a <file>.digests sidecar that is published to digest_dir for step 4.
 */
 if (paired == true){
     process contam_removal_paired {
 
         tag { dataset_id }
 
-        publishDir "${output_dir}/", mode: 'copy'
+        publishDir "${output_dir}/", pattern: '*.fastq.gz', mode: 'copy'
+        publishDir "${digest_dir}/", pattern: '*.digests', mode: 'copy'
 
         input:
-        set val(dataset_id), read1, read2, file(nonhm), file(hum) from non_human_list
+        set val(dataset_id), read1, read2, file(hum) from human_list
+        file(removal_scripts) from removal_py
 
         output:
         file("${dataset_id}_C1.fastq.gz")
         file("${dataset_id}_C2.fastq.gz")
+        file("${dataset_id}_C{1,2}.fastq.gz.digests")
 
         script:
         """
-        cat <<- EOF >> fixheaders.py
-        import re
-        import sys
-
-        p = re.compile("^(@[^\\s]+)\\/([0-9]+)\$")
+        set -o pipefail
 
-        prevLine = None
-
-        for line in sys.stdin:
-            m = p.match(line)
-            if m and prevLine != "+\\n":
-                sys.stdout.write(m.group(1) + '\\n')
-            else:
-                sys.stdout.write(line)
-            prevLine = line
-        EOF
-
-        zcat ${read1} | python3 fixheaders.py | gzip > ${dataset_id}_1.fix
-        zcat ${read2} | python3 fixheaders.py | gzip > ${dataset_id}_2.fix
-
-        seqtk subseq ${dataset_id}_1.fix ${nonhm} | gzip > "${dataset_id}_C1.fastq.gz"
-        seqtk subseq ${dataset_id}_2.fix ${nonhm} | gzip > "${dataset_id}_C2.fastq.gz"
-
-        rm ${dataset_id}_1.fix
-        rm ${dataset_id}_2.fix
-        rm ${dataset_id}.classification_non_human_read_list.txt
+        zcat ${read1} | python3 fastq.py filter --exclude --after "==== human reads ====" ${hum} | gzip | python3 hashing.py tee-digest "${dataset_id}_C1.fastq.gz"
+        zcat ${read2} | python3 fastq.py filter --exclude --after "==== human reads ====" ${hum} | gzip | python3 hashing.py tee-digest "${dataset_id}_C2.fastq.gz"
         """
     }
 }
@@ -344,39 +310,22 @@ else{
 
     tag { dataset_id }
 
-    publishDir "${output_dir}/", mode: 'copy'
+    publishDir "${output_dir}/", pattern: '*.fastq.gz', mode: 'copy'
+    publishDir "${digest_dir}/", pattern: '*.digests', mode: 'copy'
 
     input:
-    set val(dataset_id), read1, file(nonhm), file(hum) from non_human_list
+    set val(dataset_id), read1, file(hum) from human_list
+    file(removal_scripts) from removal_py
 
     output:
     file("${dataset_id}_C1.fastq.gz")
+    file("${dataset_id}_C1.fastq.gz.digests")
 
     script:
     """
-    cat <<- EOF >> fixheaders.py
-    import re
-    import sys
-
-    p = re.compile("^(@[^\\s]+)\\/([0-9]+)\$")
-
-    prevLine = None
-
-    for line in sys.stdin:
-        m = p.match(line)
-        if m and prevLine != "+\\n":
-            sys.stdout.write(m.group(1) + '\\n')
-        else:
-            sys.stdout.write(line)
-        prevLine = line
-    EOF
-
-    zcat ${read1} | python3 fixheaders.py | gzip > ${dataset_id}_1.fix
-
-    seqtk subseq ${dataset_id}_1.fix ${nonhm} | gzip > "${dataset_id}_C1.fastq.gz"
+    set -o pipefail
 
-    rm ${dataset_id}_1.fix
-    rm ${dataset_id}.classification_non_human_read_list.txt
+    zcat ${read1} | python3 fastq.py filter --exclude --after "==== human reads ====" ${hum} | gzip | python3 hashing.py tee-digest "${dataset_id}_C1.fastq.gz"
     """
     }
 }
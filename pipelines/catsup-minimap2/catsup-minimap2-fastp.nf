@@ -142,7 +142,7 @@ process process_deplete {
     """
     # DEPLETE BEGIN
 
-    minimap2 -ax sr ${db} ${forward} ${reverse} | \\
+    minimap2 -t ${task.cpus} -ax sr ${db} ${forward} ${reverse} | \\
     tee >(samtools view -b -f 4 -F 264 - | samtools sort -o unmapped1.sorted.bam ) \\
     >(samtools view -b -f 8 -F 260 - | samtools sort -o unmapped2.sorted.bam ) \\
     >(samtools view -b -f 12 -F 256 - | samtools sort -o unmapped3.sorted.bam ) | \\
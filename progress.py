@@ -0,0 +1,115 @@
+"""
+Upload progress reporting.
+
+An UploadProgress counts the bytes sent for every file of a submission
+and regularly writes a small JSON status file with the bytes sent, the
+throughput over the last few seconds and the estimated time left, for
+the web UI to show.
+"""
+
+import collections
+import json
+import os
+import pathlib
+import threading
+import time
+
+
+class UploadProgress:
+    def __init__(self, path, window=10, interval=1):
+        """
+        path is the status file. Throughput is averaged over the last
+        window seconds and the file is rewritten at most every interval
+        seconds while bytes are being sent
+        """
+        self.path = pathlib.Path(path)
+        self.window = window
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.files = dict()
+        self.sent = 0
+        self.samples = collections.deque()
+        self.last_write = 0
+        self.start = time.monotonic()
+
+    def add_file(self, name, size):
+        with self.lock:
+            self.files[name] = {"sent": 0, "size": size, "state": "queued"}
+
+    def start_file(self, name):
+        with self.lock:
+            self.files[name]["state"] = "uploading"
+        self.write()
+
+    def finish_file(self, name, ok):
+        with self.lock:
+            f = self.files[name]
+            f["state"] = "done" if ok else "failed"
+            if ok:
+                f["sent"] = f["size"]
+        self.write()
+
+    def add(self, name, nbytes):
+        """
+        Count nbytes sent for file name
+        """
+        now = time.monotonic()
+        with self.lock:
+            f = self.files[name]
+            # bytes sent again by a retry don't count twice towards the file
+            f["sent"] = min(f["size"], f["sent"] + nbytes)
+            self.sent += nbytes
+            self.samples.append((now, self.sent))
+            while self.samples and self.samples[0][0] < now - self.window:
+                self.samples.popleft()
+            due = now - self.last_write >= self.interval
+        if due:
+            self.write()
+
+    def throughput(self):
+        """
+        Bytes per second over the last window seconds
+        """
+        if len(self.samples) < 2:
+            return 0
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        if time.monotonic() - t1 > self.window:
+            return 0
+        return (b1 - b0) / max(t1 - t0, 0.001)
+
+    def status(self):
+        with self.lock:
+            throughput = self.throughput()
+            total = sum(f["size"] for f in self.files.values())
+            done = sum(f["sent"] for f in self.files.values())
+            return {
+                "bytes_sent": done,
+                "bytes_total": total,
+                "throughput": round(throughput),
+                "eta": round((total - done) / throughput) if throughput else None,
+                "elapsed": round(time.monotonic() - self.start),
+                "files": {
+                    name: [f["sent"], f["size"], f["state"]]
+                    for name, f in sorted(self.files.items())
+                },
+            }
+
+    def write(self):
+        with self.lock:
+            status = self.status()
+            self.last_write = time.monotonic()
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "w") as f:
+                f.write(json.dumps(status, separators=(",", ":")))
+            os.replace(tmp, self.path)
+
+
+def read_progress(path):
+    """
+    Return the status written by UploadProgress, or None
+    """
+    try:
+        with open(path) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
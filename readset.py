@@ -0,0 +1,144 @@
+"""
+Compact sets of read IDs.
+
+A ReadSet keeps a sorted array of 64-bit fingerprints of the read IDs
+instead of the IDs themselves, so it needs 8 bytes per read where a set
+of bytes objects needs over 100 for a typical Illumina read ID. Lookups
+are a binary search of the array.
+
+The fingerprint is Python's own 64-bit hash of the ID, which is fast but
+seeded per process, so a ReadSet is only meaningful in the process that
+built it and is never saved.
+
+The set is built in chunks: each chunk of fingerprints is sorted on its
+own and the sorted chunks are merged, so building it never needs more
+than one chunk of Python ints at a time.
+
+Two different read IDs have the same fingerprint with a probability of
+about n^2 / 2^65, around 1 in 4000 for a hundred million reads. A clash
+only means that one extra read is treated as a member.
+
+fastq.py imports this module inside the pipeline containers, so it keeps
+to the standard library.
+"""
+
+import argparse
+import array
+import bisect
+import heapq
+import io
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+CHUNK_SIZE = 1000000
+MASK = (1 << 64) - 1
+
+
+def fingerprint(read_id: bytes) -> int:
+    return hash(read_id) & MASK
+
+
+class ReadSet:
+    def __init__(self, fingerprints=None):
+        """
+        fingerprints is a sorted array('Q')
+        """
+        if fingerprints is None:
+            fingerprints = array.array("Q")
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def from_ids(cls, read_ids, chunk_size=CHUNK_SIZE):
+        read_ids = iter(read_ids)
+        chunks = list()
+        while True:
+            chunk = sorted(map(fingerprint, itertools.islice(read_ids, chunk_size)))
+            if not chunk:
+                break
+            chunks.append(array.array("Q", chunk))
+        if len(chunks) == 1:
+            return cls(chunks[0])
+        # a read ID listed twice is kept twice, which costs 8 bytes but
+        # doesn't change the lookups
+        return cls(array.array("Q", heapq.merge(*chunks)))
+
+    def __contains__(self, read_id):
+        fp = fingerprint(read_id)
+        i = bisect.bisect_left(self.fingerprints, fp)
+        return i < len(self.fingerprints) and self.fingerprints[i] == fp
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def nbytes(self):
+        return self.fingerprints.itemsize * len(self.fingerprints)
+
+
+def measure(build):
+    """
+    Return (object, bytes allocated while building it, build seconds)
+    """
+    t0 = time.perf_counter()
+    build()
+    build_time = time.perf_counter() - t0
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size, build_time
+
+
+def benchmark(count=1000000, lookups=100000):
+    """
+    Compare the memory use and speed of a ReadSet and a set of bytes
+    holding count Illumina-style read IDs, read from a read list
+    """
+    read_list = b"".join(
+        b"M01234:52:000000000-A1B2C:1:%d:%d:%d\n" % (i // 100000, i % 100000, i)
+        for i in range(count)
+    )
+    read_ids = read_list.split()
+    queries = random.sample(read_ids, min(lookups, count))
+    queries += [b"missing:%d" % i for i in range(lookups)]
+    del read_ids
+
+    def read_ids():
+        return (line.rstrip() for line in io.BytesIO(read_list))
+
+    for name, build in [
+        ("set", lambda: set(read_ids())),
+        ("ReadSet", lambda: ReadSet.from_ids(read_ids())),
+    ]:
+        obj, size, build_time = measure(build)
+        t0 = time.perf_counter()
+        for q in queries:
+            q in obj
+        lookup_time = time.perf_counter() - t0
+        print(
+            f"{name:8} {size / count:6.1f} bytes/read  "
+            f"build {build_time:5.2f}s  "
+            f"lookup {lookup_time / len(queries) * 1e6:5.2f}us"
+        )
+        del obj
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact sets of read IDs")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser("benchmark", help="compare a ReadSet with a set")
+    p.add_argument("--count", type=int, default=1000000)
+    p.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark":
+        benchmark(args.count, args.lookups)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Per-run resource settings for the pipelines.
+
+The .nf files give every process a fixed amount of memory and no CPU
+count. plan() sizes the processes of one run instead, from the sizes of
+the input files, the size of the human reference database and the cores
+and memory of the host, and write_config() writes the result as a
+Nextflow config file. run_pipeline passes it to nextflow with -c, and
+its withName settings take precedence over the directives in the .nf
+files.
+
+The classifiers load the whole database into memory, so their memory
+follows the database and the number of them that fit in memory at once
+decides how many cores each one gets. Trimming and read removal need a
+little memory that grows with the largest sample.
+
+The cores and memory of the host only bound the processes when they run
+on it. With another executor, eg. -process.executor slurm in
+nextflow_additional_params, each process gets what it needs and the
+scheduler finds a node for it.
+"""
+
+import pathlib
+import shlex
+
+import argh
+import psutil
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# left for catsup itself and the rest of the host
+RESERVED_MEMORY = 1 * GB
+MIN_MEMORY = 512 * MB
+
+# process name patterns, covering all the pipelines
+PROCESSES = {
+    "trim": "process_trim.*|process_paired|process_single",
+    "classification": ".*classification.*|process_deplete",
+    "removal": "contam_removal.*",
+}
+
+
+def path_size(path):
+    """
+    Size of a file, of all the files in a directory, or of all the files
+    starting with path. (a centrifuge index is given by its prefix)
+    """
+    path = pathlib.Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    if path.is_dir():
+        files = path.rglob("*")
+    else:
+        files = path.parent.glob(path.name + ".*")
+    return sum(f.stat().st_size for f in files if f.is_file())
+
+
+def is_local_executor(nextflow_params):
+    """
+    Whether nextflow runs the processes on this host, going by the
+    -process.executor setting in the nextflow command line parameters
+    """
+    args = shlex.split(nextflow_params or "")
+    executor = "local"
+    for i, arg in enumerate(args):
+        if arg == "-process.executor" and i + 1 < len(args):
+            executor = args[i + 1]
+        elif arg.startswith("-process.executor="):
+            executor = arg.split("=", 1)[1]
+    return executor == "local"
+
+
+def sample_sizes(input_dir):
+    """
+    Return {sample: total size of its fastq.gz files} for the pipeline
+    input directory, where sample_1.fastq.gz and sample_2.fastq.gz are
+    one sample
+    """
+    sizes = dict()
+    for f in pathlib.Path(input_dir).glob("*.fastq.gz"):
+        sample = f.name[: -len(".fastq.gz")]
+        if sample[-2:] in ["_1", "_2"]:
+            sample = sample[:-2]
+        sizes[sample] = sizes.get(sample, 0) + f.stat().st_size
+    return sizes
+
+
+def plan(input_dir, db, cpus=None, memory=None, local=True):
+    """
+    Return ({"cpus": cpus, "memory": bytes} for the local executor, or None
+    if not local, {process group in PROCESSES: {"cpus": cpus, "memory": bytes}})
+
+    cpus and memory are those of the host unless given. A classifier is
+    never given less memory than its database needs, even if that is more
+    than the host has
+    """
+    sizes = sample_sizes(input_dir)
+    largest = max(sizes.values(), default=0)
+    classification_memory = int(max(path_size(db) * 1.1 + GB, MIN_MEMORY))
+
+    if not local:
+        # the host's cores are not the nodes' cores, so leave the cpus of
+        # the classifiers to the .nf files
+        return None, {
+            "trim": {"cpus": 1, "memory": int(GB + largest // 16)},
+            "classification": {"cpus": None, "memory": classification_memory},
+            "removal": {"cpus": 2, "memory": int(GB // 2 + largest // 10)},
+        }
+
+    cpus = cpus or psutil.cpu_count() or 1
+    memory = memory or psutil.virtual_memory().total
+    usable = max(memory - RESERVED_MEMORY, MIN_MEMORY)
+
+    def clamp(m):
+        return int(min(max(m, MIN_MEMORY), usable))
+
+    at_once = max(1, min(len(sizes), usable // classification_memory))
+
+    executor = {"cpus": cpus, "memory": max(usable, classification_memory)}
+    processes = {
+        "trim": {"cpus": 1, "memory": clamp(GB + largest // 16)},
+        "classification": {
+            "cpus": max(1, cpus // at_once),
+            "memory": classification_memory,
+        },
+        # 8 bytes per listed read, of which there are at most one per
+        # ~80 bytes of gzipped FASTQ. 2 cpus for the zcat and gzip around it
+        "removal": {"cpus": min(2, cpus), "memory": clamp(GB // 2 + largest // 10)},
+    }
+    return executor, processes
+
+
+def write_config(config_file, executor, processes):
+    lines = ["// Written by catsup resources.py for this run"]
+    if executor:
+        lines += [
+            "executor {",
+            f"    cpus = {executor['cpus']}",
+            f"    memory = '{executor['memory'] // MB} MB'",
+            "}",
+        ]
+    lines.append("process {")
+    for group, pattern in PROCESSES.items():
+        lines.append(f"    withName: '{pattern}' {{")
+        if processes[group]["cpus"]:
+            lines.append(f"        cpus = {processes[group]['cpus']}")
+        lines += [
+            f"        memory = '{processes[group]['memory'] // MB} MB'",
+            "    }",
+        ]
+    lines.append("}")
+    with open(config_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@argh.arg("--cpus", type=int)
+@argh.arg("--memory-gb", type=float)
+def write_run_config(
+    input_dir, db, config_file, cpus=None, memory_gb=None, executor="local"
+):
+    """
+    Write the Nextflow config for a run with the samples in input_dir and
+    the human reference db
+    """
+    memory = int(memory_gb * GB) if memory_gb else None
+    local = executor == "local"
+    write_config(config_file, *plan(input_dir, db, cpus, memory, local))
+    print(pathlib.Path(config_file).read_text(), end="")
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([write_run_config])
@@ -0,0 +1,198 @@
+"""
+Retry scheduling for uploads.
+
+A RetryPolicy decides how long to sleep between attempts (capped
+exponential backoff with full jitter) and when to give up (attempt limit,
+per-file and per-submission deadlines). A CircuitBreaker per endpoint
+stops every upload thread from hammering a server that is down: after
+enough consecutive failures it opens, and callers wait until a single
+probe request has succeeded again.
+"""
+
+import datetime
+import random
+import threading
+import time
+
+
+class Deadline:
+    """
+    A point in time after which no more attempts should be started.
+    Deadline(None) never expires
+    """
+
+    def __init__(self, seconds=None):
+        self.end = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        if self.end is None:
+            return float("inf")
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    @staticmethod
+    def earliest(*deadlines):
+        return min(deadlines, key=lambda x: x.remaining())
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. Open (after failure_threshold consecutive
+    failures): calls wait for reset_timeout seconds. Then one probe call
+    is let through; its success closes the breaker, its failure opens it
+    again
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def wait_time(self):
+        """
+        Return 0 if a call may be made now, otherwise the number of seconds
+        to wait before asking again
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            left = self.opened_at + self.reset_timeout - time.monotonic()
+            if left > 0:
+                return left
+            if self.probing:
+                return min(1.0, self.reset_timeout)
+            self.probing = True
+            return 0
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+BREAKERS = dict()
+BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(key, failure_threshold=5, reset_timeout=60):
+    """
+    Return the process-wide circuit breaker for key (eg. a host name)
+    """
+    with BREAKERS_LOCK:
+        if key not in BREAKERS:
+            BREAKERS[key] = CircuitBreaker(failure_threshold, reset_timeout)
+        return BREAKERS[key]
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts=12,
+        base_delay=1,
+        max_delay=300,
+        file_deadline=None,
+        submission_deadline=None,
+        breaker_failures=5,
+        breaker_reset=60,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.file_deadline = file_deadline
+        self.submission_deadline = submission_deadline
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+
+    def delay(self, attempt):
+        """
+        Seconds to sleep after failed attempt number attempt (from 1)
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def breaker(self, key):
+        return get_breaker(key, self.breaker_failures, self.breaker_reset)
+
+
+def call(fn, policy, deadline=None, breaker=None, retryable=None, log=print):
+    """
+    Call fn until it succeeds or the policy gives up
+
+    Return None on success. Otherwise return the list of attempts, each a
+    dict with the time, attempt number, error and the sleep that followed.
+    retryable(exception) can return False to give up straight away
+    """
+    deadline = Deadline.earliest(
+        deadline or Deadline(), Deadline(policy.file_deadline)
+    )
+    attempts = list()
+    attempt = 0
+    while True:
+        wait = breaker.wait_time() if breaker else 0
+        if wait:
+            if wait >= deadline.remaining():
+                attempts.append(
+                    {
+                        "time": datetime.datetime.now().isoformat(),
+                        "attempt": attempt,
+                        "error": "circuit breaker open until after the deadline",
+                        "sleep": 0,
+                    }
+                )
+                return attempts
+            time.sleep(wait)
+            continue
+
+        attempt += 1
+        try:
+            fn()
+            if breaker:
+                breaker.success()
+            return None
+        except Exception as e:
+            give_up = retryable is not None and not retryable(e)
+            if breaker and give_up:
+                # the server answered, it just won't accept this request.
+                # that also ends a probe, which would otherwise hold the
+                # breaker half-open for every later call
+                breaker.success()
+            elif breaker:
+                breaker.failure()
+            sleep = policy.delay(attempt)
+            give_up = (
+                give_up
+                or attempt >= policy.max_attempts
+                or sleep >= deadline.remaining()
+            )
+            attempts.append(
+                {
+                    "time": datetime.datetime.now().isoformat(),
+                    "attempt": attempt,
+                    "error": str(e),
+                    "sleep": 0 if give_up else round(sleep, 3),
+                }
+            )
+            if give_up:
+                return attempts
+            log(f"Error in upload. Attempt {attempt}. Sleeping for {sleep:.1f} seconds")
+            time.sleep(sleep)
@@ -0,0 +1,399 @@
+"""
+Upload to an S3-compatible bucket.
+
+Requests are signed with AWS Signature Version 4 and sent over the
+connection pool in par_upload, with the same retry policy, bandwidth
+limit and upload journal as PAR uploads. Files are uploaded in parallel,
+large files with a multipart upload that can be resumed.
+
+The credentials and endpoint are read from the s3cmd config file named
+by upload.s3.s3cmd-config. Keys of the same name in upload.s3 override
+them.
+"""
+
+import configparser
+import datetime
+import hashlib
+import hmac
+import math
+import pathlib
+import re
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import argh
+
+import par_upload
+import retry
+import throttle
+
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+S3CMD_KEYS = ["access_key", "secret_key", "host_base", "use_https", "bucket_location"]
+
+
+def quote(s, safe="/"):
+    return urllib.parse.quote(s, safe=safe + "-_.~")
+
+
+def hmac_sha256(key, msg):
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def sign(
+    method,
+    url,
+    headers,
+    access_key,
+    secret_key,
+    region,
+    payload_hash=UNSIGNED_PAYLOAD,
+    now=None,
+):
+    """
+    Return headers with the AWS Signature Version 4 headers added
+
+    url must already be quoted
+    """
+    u = urllib.parse.urlsplit(url)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+
+    headers = dict(headers)
+    headers["Host"] = u.netloc
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_hash
+    canonical_headers = sorted((k.lower(), str(v).strip()) for k, v in headers.items())
+    signed_headers = ";".join(k for k, _ in canonical_headers)
+    query = sorted(urllib.parse.parse_qsl(u.query, keep_blank_values=True))
+    canonical_request = "\n".join(
+        [
+            method,
+            u.path or "/",
+            "&".join(f"{quote(k, '')}={quote(v, '')}" for k, v in query),
+            "".join(f"{k}:{v}\n" for k, v in canonical_headers),
+            signed_headers,
+            payload_hash,
+        ]
+    )
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+
+    key = ("AWS4" + secret_key).encode()
+    for part in [amz_date[:8], region, "s3", "aws4_request"]:
+        key = hmac_sha256(key, part)
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    return headers
+
+
+def read_s3_config(s3_cfg):
+    """
+    Return the S3 settings from the s3cmd config file in the upload.s3
+    config block, overridden by the block's own keys
+    """
+    settings = {
+        "host_base": "s3.amazonaws.com",
+        "use_https": "True",
+        "bucket_location": "us-east-1",
+    }
+    if s3_cfg.get("s3cmd-config"):
+        ini = configparser.ConfigParser(interpolation=None)
+        ini.read(s3_cfg["s3cmd-config"])
+        if ini.has_section("default"):
+            for k in S3CMD_KEYS:
+                if ini.get("default", k, fallback=None):
+                    settings[k] = ini.get("default", k)
+    for k in S3CMD_KEYS:
+        if k in s3_cfg:
+            settings[k] = s3_cfg[k]
+    return settings
+
+
+class S3Client:
+    def __init__(self, endpoint, access_key, secret_key, region="us-east-1"):
+        self.endpoint = endpoint.rstrip("/")
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+
+    @classmethod
+    def from_config(cls, s3_cfg):
+        settings = read_s3_config(s3_cfg)
+        use_https = str(settings["use_https"]).lower() in ["true", "yes", "1"]
+        region = settings["bucket_location"]
+        if region in ["US", ""]:
+            # s3cmd's name for the default region
+            region = "us-east-1"
+        return cls(
+            f"{'https' if use_https else 'http'}://{settings['host_base']}",
+            settings["access_key"],
+            settings["secret_key"],
+            region,
+        )
+
+    def url(self, bucket, key, query=""):
+        """
+        Path-style url of key in bucket, which works with S3-compatible
+        stores that don't have per-bucket host names
+        """
+        return f"{self.endpoint}/{bucket}/{quote(key)}" + (f"?{query}" if query else "")
+
+    def request(self, method, url, headers=None, **kwargs):
+        headers = sign(
+            method,
+            url,
+            headers or dict(),
+            self.access_key,
+            self.secret_key,
+            self.region,
+        )
+        return par_upload.http_request(method, url, headers=headers, **kwargs)
+
+    def put_file(self, bucket, key, u_file, on_send=None, on_progress=None):
+        with open(u_file, "rb") as f:
+            size = pathlib.Path(u_file).stat().st_size
+            self.request(
+                "PUT",
+                self.url(bucket, key),
+                body_file=f,
+                body_length=size,
+                on_send=on_send,
+                on_progress=on_progress,
+            )
+
+    def put_file_multipart(
+        self,
+        bucket,
+        key,
+        u_file,
+        state_file,
+        part_size=par_upload.PART_SIZE,
+        on_send=None,
+        on_progress=None,
+    ):
+        """
+        Upload u_file with an S3 multipart upload
+
+        Finished parts and their ETags are recorded in state_file, so a
+        retry (or a new process) only sends the parts that are missing.
+        """
+        state = par_upload.load_multipart_state(state_file, u_file, part_size)
+        stale_access_uri = state.pop("stale_access_uri", None)
+        if stale_access_uri:
+            # the file changed under an unfinished upload. abort it
+            try:
+                self.request("DELETE", f"{self.endpoint}{stale_access_uri}")
+            except Exception:
+                pass
+
+        try:
+            if not state["access_uri"]:
+                _, _, data = self.request("POST", self.url(bucket, key, "uploads="))
+                upload_id = xml_text(data, "UploadId")
+                state["access_uri"] = (
+                    f"/{bucket}/{quote(key)}?uploadId={quote(upload_id, '')}"
+                )
+                state["etags"] = dict()
+                par_upload.save_multipart_state(state_file, state)
+            upload_url = f"{self.endpoint}{state['access_uri']}"
+
+            size = state["size"]
+            part_count = max(1, math.ceil(size / part_size))
+            with open(u_file, "rb") as f:
+                for part_num in range(1, part_count + 1):
+                    if part_num in state["parts"]:
+                        continue
+                    offset = (part_num - 1) * part_size
+                    f.seek(offset)
+                    _, headers, _ = self.request(
+                        "PUT",
+                        f"{upload_url}&partNumber={part_num}",
+                        body_file=f,
+                        body_length=min(part_size, size - offset),
+                        on_send=on_send,
+                        on_progress=on_progress,
+                    )
+                    etags = {k.lower(): v for k, v in headers.items()}
+                    state["etags"][str(part_num)] = etags["etag"]
+                    state["parts"].append(part_num)
+                    par_upload.save_multipart_state(state_file, state)
+
+            parts = "".join(
+                f"<Part><PartNumber>{n}</PartNumber>"
+                f"<ETag>{state['etags'][str(n)]}</ETag></Part>"
+                for n in range(1, part_count + 1)
+            )
+            body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>"
+            _, _, data = self.request("POST", upload_url, body=body.encode())
+            # S3 can report a failed completion with HTTP 200
+            if re.search(rb"<Error>", data):
+                raise par_upload.UploadError(
+                    f"POST {upload_url} failed: {xml_text(data, 'Message')}", 500
+                )
+        except par_upload.UploadError as e:
+            if e.status == 404:
+                # the multipart upload expired or was aborted. start again next time
+                par_upload.remove_multipart_state(state_file)
+            raise
+
+        par_upload.remove_multipart_state(state_file)
+
+
+def xml_text(data, tag):
+    """
+    Return the text of the first tag element in an S3 XML response
+    """
+    for element in ET.fromstring(data).iter():
+        if element.tag.split("}")[-1] == tag:
+            return element.text
+    raise par_upload.UploadError(f"No {tag} in response: {data[:200]}")
+
+
+def bucket_name(bucket):
+    """
+    s3://bucket or bucket -> bucket
+    """
+    return bucket[len("s3://") :] if bucket.startswith("s3://") else bucket
+
+
+def upload_file(
+    client,
+    bucket,
+    u_file,
+    cloud_prefix,
+    multipart_threshold=par_upload.MULTIPART_THRESHOLD,
+    part_size=par_upload.PART_SIZE,
+    policy=None,
+    deadline=None,
+    progress=None,
+):
+    """
+    Upload u_file to bucket/cloud_prefix/. Files larger than
+    multipart_threshold are uploaded in parts, recording progress in
+    .s3_multipart/ next to the upload directory. Bytes sent are counted
+    in progress, if given
+    """
+    u_file = pathlib.Path(u_file)
+    bucket = bucket_name(bucket)
+    key = f"{cloud_prefix}/{u_file.name}"
+    policy = policy or par_upload.POLICY
+    breaker = policy.breaker(urllib.parse.urlsplit(client.endpoint).netloc)
+
+    def on_send(n):
+        throttle.LIMITER.consume(cloud_prefix, n)
+
+    def on_progress(n):
+        if progress:
+            progress.add(u_file.name, n)
+
+    if u_file.stat().st_size > multipart_threshold:
+        state_file = (
+            u_file.absolute().parent.parent / ".s3_multipart" / f"{u_file.name}.json"
+        )
+        return par_upload.run(
+            f"PUT {u_file} s3://{bucket}/{key} (multipart)",
+            lambda: client.put_file_multipart(
+                bucket, key, u_file, state_file, part_size, on_send, on_progress
+            ),
+            policy=policy,
+            deadline=deadline,
+            breaker=breaker,
+        )
+    return par_upload.run(
+        f"PUT {u_file} s3://{bucket}/{key}",
+        lambda: client.put_file(bucket, key, u_file, on_send, on_progress),
+        policy=policy,
+        deadline=deadline,
+        breaker=breaker,
+    )
+
+
+def upload_dir(
+    client,
+    bucket,
+    u_dir,
+    cloud_prefix,
+    workers=1,
+    multipart_threshold=par_upload.MULTIPART_THRESHOLD,
+    part_size=par_upload.PART_SIZE,
+    policy=None,
+    progress=None,
+):
+    """
+    Upload every file in u_dir to bucket/cloud_prefix/, up to workers
+    files at a time. sp3data.csv is uploaded last, once all the other
+    files have succeeded
+
+    Files that the submission's upload journal shows as already uploaded
+    are skipped. The returned error dict is like par_upload.upload_dir's
+    """
+    policy = policy or par_upload.POLICY
+    deadline = retry.Deadline(policy.submission_deadline)
+    journal = par_upload.open_journal(
+        u_dir, f"s3://{bucket_name(bucket)}/{cloud_prefix}/"
+    )
+    u_files = sorted(x for x in pathlib.Path(u_dir).glob("*") if not journal.is_done(x))
+
+    def upload_fn(u_file):
+        return upload_file(
+            client,
+            bucket,
+            u_file,
+            cloud_prefix,
+            multipart_threshold,
+            part_size,
+            policy,
+            deadline,
+            progress,
+        )
+
+    last = [x for x in u_files if x.name == "sp3data.csv"]
+    first = [x for x in u_files if x.name != "sp3data.csv"]
+    if progress:
+        # count sp3data.csv from the start, although it is sent last
+        for u_file in last:
+            progress.add_file(u_file.name, u_file.stat().st_size)
+    return par_upload.upload_files(
+        first, journal, upload_fn, workers, cloud_prefix, progress
+    ) or par_upload.upload_files(
+        last, journal, upload_fn, workers, cloud_prefix, progress
+    )
+
+
+def upload_run(
+    s3cmd_config,
+    bucket,
+    u_dir,
+    workers=1,
+    multipart_threshold=par_upload.MULTIPART_THRESHOLD,
+    part_size=par_upload.PART_SIZE,
+    policy=None,
+):
+    client = S3Client.from_config({"s3cmd-config": s3cmd_config})
+    u_dir = pathlib.Path(u_dir) / "upload"
+    submission_uuid4 = par_upload.get_submission_name_from_sp3data_csv(u_dir)
+    return upload_dir(
+        client,
+        bucket,
+        u_dir,
+        submission_uuid4,
+        workers,
+        multipart_threshold,
+        part_size,
+        policy,
+    )
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([upload_run])
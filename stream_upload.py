@@ -0,0 +1,85 @@
+"""
+Upload clean files while the pipeline is still running.
+
+The pipeline publishes every clean file into upload/ as soon as its sample
+is done, together with a digest sidecar in upload_digests/. A
+StreamingUploader polls for clean files whose sidecar matches their size
+(so the copy into upload/ has finished) and uploads them in the
+background, recording them in the submission's upload journal. Step 4
+then only uploads what is left, followed by sp3data.csv and the
+upload_done.txt marker.
+"""
+
+import concurrent.futures
+import logging
+import pathlib
+import threading
+
+import hashing
+
+
+class StreamingUploader(threading.Thread):
+    def __init__(
+        self, u_dir, digest_dir, filenames, journal, upload_fn, workers=1, interval=5
+    ):
+        """
+        filenames are the clean files the pipeline is expected to publish
+        into u_dir. upload_fn(u_file) uploads one file and returns None on
+        success or an error dict
+        """
+        super().__init__(daemon=True)
+        self.u_dir = pathlib.Path(u_dir)
+        self.digest_dir = pathlib.Path(digest_dir)
+        self.pending = list(filenames)
+        self.journal = journal
+        self.upload_fn = upload_fn
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        self.errors = dict()
+
+    def ready(self, filename):
+        """
+        Return the digests of filename if it has been published completely
+        """
+        u_file = self.u_dir / filename
+        if not u_file.exists():
+            return None
+        return hashing.read_digests(u_file, self.digest_dir)
+
+    def upload_one(self, u_file):
+        if self.journal.is_done(u_file):
+            return
+        logging.info(f"Streaming upload of {u_file}")
+        self.journal.record(u_file, "uploading")
+        error = self.upload_fn(u_file)
+        self.journal.record(u_file, "failed" if error else "done")
+        if error:
+            # step 4 will try it again
+            logging.error(f"Streaming upload of {u_file} failed: {error}")
+            self.errors[u_file.name] = error
+
+    def scan(self):
+        for filename in list(self.pending):
+            digests = self.ready(filename)
+            if not digests:
+                continue
+            self.pending.remove(filename)
+            self.journal.known_md5s[filename] = digests[0]
+            self.pool.submit(self.upload_one, self.u_dir / filename)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.scan()
+
+    def finish(self):
+        """
+        Upload the files that were published since the last scan and wait
+        for all uploads to end
+        """
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        self.scan()
+        self.pool.shutdown(wait=True)
+        return self.errors
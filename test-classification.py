@@ -0,0 +1,74 @@
+# Test classification.py
+# Run all tests: python3 test-classification.py
+# Run one test:  python3 test-classification.py TestClassification.test_kraken2
+
+import io
+import pathlib
+import subprocess
+import tempfile
+import unittest
+
+import classification
+
+KRAKEN2 = b"""C\tread1\t9606\t150|150\t9606:116
+U\tread2\t0\t150|150\t0:116
+C\tread3\t1773\t150|150\t1773:116
+C\tread4\t9606\t150|150\t9606:116
+"""
+
+CENTRIFUGE = b"""readID\tseqID\ttaxID\tscore\t2ndBestScore\thitLength\tqueryLength\tnumMatches
+read1\tNC_000001\t9606\t100\t0\t50\t200\t1
+read2\tunclassified\t0\t0\t0\t0\t200\t1
+read3\tNC_000962.3\t1773\t100\t0\t50\t200\t1
+"""
+
+
+def split(data, layout):
+    human, non_human = io.BytesIO(), io.BytesIO()
+    counts = classification.split_stream(io.BytesIO(data), human, non_human, layout)
+    return human.getvalue(), non_human.getvalue(), counts
+
+
+class TestClassification(unittest.TestCase):
+    def test_kraken2(self):
+        self.assertEqual(
+            (b"read1\nread4\n", b"read2\nread3\n", [2, 2]), split(KRAKEN2, "kraken2")
+        )
+
+    def test_centrifuge(self):
+        self.assertEqual(
+            (b"read1\n", b"read2\nread3\n", [1, 2]), split(CENTRIFUGE, "centrifuge")
+        )
+
+    def test_human_only(self):
+        human = io.BytesIO()
+        counts = classification.split_stream(io.BytesIO(KRAKEN2), human)
+        self.assertEqual((b"read1\nread4\n", [2, 2]), (human.getvalue(), counts))
+
+    def test_split_appends_human_list(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            (tmp / "table.txt").write_bytes(KRAKEN2)
+            (tmp / "human.txt").write_bytes(b"==== human reads ====\n")
+            (tmp / "non_human.txt").write_bytes(b"old\n")
+            subprocess.check_call(
+                [
+                    "python3",
+                    "classification.py",
+                    "split",
+                    tmp / "table.txt",
+                    tmp / "human.txt",
+                    "--non-human-list",
+                    tmp / "non_human.txt",
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+            self.assertEqual(
+                b"==== human reads ====\nread1\nread4\n",
+                (tmp / "human.txt").read_bytes(),
+            )
+            self.assertEqual(b"read2\nread3\n", (tmp / "non_human.txt").read_bytes())
+
+
+if __name__ == "__main__":
+    unittest.main()
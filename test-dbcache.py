@@ -0,0 +1,125 @@
+# Test dbcache.py
+# Run all tests: python3 test-dbcache.py
+# Run one test:  python3 test-dbcache.py TestDbCache.test_stage_dir
+
+import os
+import pathlib
+import tempfile
+import unittest
+
+import dbcache
+
+
+class TestDbCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self.tmp.name)
+        self.cache = dbcache.DbCache(self.dir / "cache", 100)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_db(self, name, size):
+        db = self.dir / "shared" / name
+        db.mkdir(parents=True)
+        (db / "hash.k2d").write_bytes(b"h" * (size - 10))
+        (db / "taxo.k2d").write_bytes(b"t" * 10)
+        return db
+
+    def test_stage_dir(self):
+        db = self.make_db("k2_human", 50)
+        staged = self.cache.stage(db)
+        local = pathlib.Path(staged.path)
+        self.assertNotEqual(db, local)
+        self.assertEqual(b"t" * 10, (local / "taxo.k2d").read_bytes())
+        staged.release()
+
+        # unchanged: the same copy is used
+        os.utime(local / "hash.k2d", (0, 0))
+        staged = self.cache.stage(db)
+        self.assertEqual(str(local), staged.path)
+        self.assertEqual(0, (local / "hash.k2d").stat().st_mtime)
+        staged.release()
+
+        # changed: copied again
+        (db / "taxo.k2d").write_bytes(b"x" * 10)
+        staged = self.cache.stage(db)
+        self.assertEqual(b"x" * 10, (local / "taxo.k2d").read_bytes())
+        staged.release()
+
+    def test_stage_missing_file(self):
+        db = self.make_db("k2_human", 50)
+        self.cache.stage(db).release()
+        local = self.dir / "cache" / self.cache.key(db)
+        (local / "hash.k2d").unlink()
+        (local / "taxo.k2d").write_bytes(b"t")
+        staged = self.cache.stage(db)
+        self.assertEqual(str(local), staged.path)
+        self.assertEqual(b"h" * 40, (local / "hash.k2d").read_bytes())
+        self.assertEqual(b"t" * 10, (local / "taxo.k2d").read_bytes())
+        staged.release()
+
+    def test_copy_fails(self):
+        a = self.make_db("a", 40)
+        b = self.make_db("b", 80)
+        self.cache.stage(a).release()
+
+        def fail(db, key):
+            raise OSError("No space left on device")
+
+        copy, self.cache.copy = self.cache.copy, fail
+        with self.assertRaises(OSError):
+            self.cache.stage(b)
+        # a was evicted to make room for b, and isn't in the index any more
+        self.assertEqual({}, self.cache.load())
+        self.cache.copy = copy
+
+        staged = self.cache.stage(a)
+        local = pathlib.Path(staged.path)
+        self.assertEqual(b"h" * 30, (local / "hash.k2d").read_bytes())
+        staged.release()
+
+    def test_stage_prefix(self):
+        shared = self.dir / "shared"
+        shared.mkdir()
+        for n in ["1", "2"]:
+            (shared / f"hg38.{n}.cf").write_bytes(b"c" * 10)
+        (shared / "other.1.cf").write_bytes(b"o")
+        staged = self.cache.stage(shared / "hg38")
+        local = pathlib.Path(staged.path)
+        self.assertEqual("hg38", local.name)
+        self.assertEqual(
+            ["hg38.1.cf", "hg38.2.cf"], sorted(x.name for x in local.parent.iterdir())
+        )
+        staged.release()
+
+    def test_evict(self):
+        a = self.make_db("a", 40)
+        b = self.make_db("b", 40)
+        c = self.make_db("c", 40)
+        self.cache.stage(a).release()
+        staged_b = self.cache.stage(b)
+
+        # a is least recently used and b is in use
+        staged_c = self.cache.stage(c)
+        self.assertNotEqual(str(c), staged_c.path)
+        self.assertFalse((self.dir / "cache" / self.cache.key(a)).exists())
+        self.assertTrue(pathlib.Path(staged_b.path).exists())
+
+        # b and c are both in use, so a can't be copied
+        self.assertEqual(str(a), self.cache.stage(a).path)
+        staged_b.release()
+        staged_a = self.cache.stage(a)
+        self.assertNotEqual(str(a), staged_a.path)
+        staged_a.release()
+        staged_c.release()
+
+    def test_too_big(self):
+        db = self.make_db("big", 200)
+        staged = self.cache.stage(db)
+        self.assertEqual(str(db), staged.path)
+        staged.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# Test fastq.py
+# Run all tests: python3 test-fastq.py
+# Run one test:  python3 test-fastq.py TestFastq.test_fix_headers
+
+import io
+import pathlib
+import random
+import re
+import subprocess
+import tempfile
+import unittest
+
+import fastq
+import readset
+
+
+def fix_headers_per_line(data):
+    """
+    The per-line script that the pipelines used to embed
+    """
+    p = re.compile("^(@[^\\s]+)\\/([0-9]+)$")
+    out = list()
+    prev_line = None
+    for line in io.StringIO(data.decode()):
+        m = p.match(line)
+        if m and prev_line != "+\n":
+            out.append(m.group(1) + "\n")
+        else:
+            out.append(line)
+        prev_line = line
+    return "".join(out).encode()
+
+
+def random_fastq(n):
+    names = ["@r{}/1", "@r{}/2", "@r{}", "@r{} 1:N:0", "@r{}/1 extra", "@a/b{}/12"]
+    reads = list()
+    for i in range(n):
+        length = random.randint(1, 150)
+        seq = "".join(random.choice("ACGTN") for _ in range(length))
+        qual = "".join(random.choice("@/0123456789ABCDEFGHI") for _ in range(length))
+        reads.append(f"{random.choice(names).format(i)}\n{seq}\n+\n{qual}\n")
+    return "".join(reads).encode()
+
+
+class TestFastq(unittest.TestCase):
+    def test_strip_read_number(self):
+        self.assertEqual(b"@read", fastq.strip_read_number(b"@read/1"))
+        self.assertEqual(b"@a/b", fastq.strip_read_number(b"@a/b/2"))
+        self.assertEqual(b"@read/1 x", fastq.strip_read_number(b"@read/1 x"))
+        self.assertEqual(b"@read/x", fastq.strip_read_number(b"@read/x"))
+        self.assertEqual(b"@/1", fastq.strip_read_number(b"@/1"))
+
+    def test_fix_headers(self):
+        random.seed(1)
+        data = random_fastq(2000)
+        # quality lines that look like headers are left alone
+        data += b"@q/1\nAC\n+\n@1/1\n"
+        expected = fix_headers_per_line(data)
+        for block_size in [1, 7, 1000, fastq.BLOCK_SIZE]:
+            out = io.BytesIO()
+            fastq.fix_headers_stream(io.BytesIO(data), out, block_size)
+            self.assertEqual(expected, out.getvalue())
+
+    def test_no_final_newline(self):
+        data = b"@r/1\nACGT\n+\nIIII\n@s/2\nAC\n+\nII"
+        out = io.BytesIO()
+        fastq.fix_headers_stream(io.BytesIO(data), out, 5)
+        self.assertEqual(b"@r\nACGT\n+\nIIII\n@s\nAC\n+\nII", out.getvalue())
+
+    def test_filter(self):
+        random.seed(2)
+        data = random_fastq(500)
+        keep = {b"r%d" % i for i in range(0, 500, 3)}
+        keep |= {b"a/b%d" % i for i in range(500)}
+        lines = data.split(b"\n")
+        fixed = fix_headers_per_line(data).split(b"\n")
+        expected = list()
+        for i in range(0, len(fixed) - 1, 4):
+            # listed with or without its read number
+            name = fastq.read_name(lines[i])
+            if {name, re.sub(rb"/[0-9]+$", b"", name)} & keep:
+                expected.extend(fixed[i : i + 4])
+        expected = b"\n".join(expected) + b"\n"
+        for block_size in [1, 100, fastq.BLOCK_SIZE]:
+            out = io.BytesIO()
+            fastq.filter_stream(io.BytesIO(data), out, keep, block_size=block_size)
+            self.assertEqual(expected, out.getvalue())
+
+    def test_filter_exclude(self):
+        data = b"@r1/1\nA\n+\nI\n@r2/1\nC\n+\nI\n@r3/1\nG\n+\nI\n"
+        out = io.BytesIO()
+        fastq.filter_stream(io.BytesIO(data), out, {b"r2"}, exclude=True)
+        self.assertEqual(b"@r1\nA\n+\nI\n@r3\nG\n+\nI\n", out.getvalue())
+
+    def test_filter_exclude_suffixed_ids(self):
+        # single-end kraken2 output keeps the /1 in the read IDs
+        data = b"@h1/1\nA\n+\nI\n@r2/1\nC\n+\nI\n"
+        human = readset.ReadSet.from_ids([b"h1/1"])
+        out = io.BytesIO()
+        fastq.filter_stream(io.BytesIO(data), out, human, exclude=True)
+        self.assertEqual(b"@r2\nC\n+\nI\n", out.getvalue())
+
+    def test_filter_exclude_crlf(self):
+        data = b"".join(
+            b"@%s/1\r\nA\r\n+\r\nI\r\n" % name for name in [b"h1", b"h2", b"r3"]
+        )
+        human = readset.ReadSet.from_ids([b"h1/1", b"h2"])
+        out = io.BytesIO()
+        fastq.filter_stream(io.BytesIO(data), out, human, exclude=True)
+        self.assertEqual(b"@r3/1\r\nA\r\n+\r\nI\r\n", out.getvalue())
+
+    def test_load_read_list(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "reads.txt"
+            path.write_bytes(b"r1\nr2\textra\n\nr3")
+            read_list = fastq.load_read_list(path)
+            self.assertEqual(3, len(read_list))
+            for read_id in [b"r1", b"r2", b"r3"]:
+                self.assertIn(read_id, read_list)
+            self.assertNotIn(b"extra", read_list)
+
+            path.write_bytes(
+                b"==== kraken2 ====\n 0.5\t9606\n==== human reads ====\nr1\n"
+            )
+            read_list = fastq.load_read_list(path, "==== human reads ====")
+            self.assertEqual(1, len(read_list))
+            self.assertIn(b"r1", read_list)
+
+    def test_cli(self):
+        data = b"@r/1\nACGT\n+\nIIII\n"
+        out = subprocess.check_output(
+            ["python3", "fastq.py", "fix-headers"], input=data
+        )
+        self.assertEqual(b"@r\nACGT\n+\nIIII\n", out)
+
+
+if __name__ == "__main__":
+    unittest.main()
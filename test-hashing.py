@@ -0,0 +1,134 @@
+# Test hashing.py
+# Run all tests: python3 test-hashing.py
+# Run one test:  python3 test-hashing.py TestHashing.test_hash_file_matches_coreutils
+
+import hashlib
+import os
+import shutil
+import subprocess
+import unittest
+
+import hashing
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree("/tmp/catsup-hashing", ignore_errors=True)
+        os.makedirs("/tmp/catsup-hashing")
+        self.data = os.urandom(1024 * 1024 + 17)
+        with open("/tmp/catsup-hashing/sample.fastq.gz", "wb") as f:
+            f.write(self.data)
+        open("/tmp/catsup-hashing/empty.fastq.gz", "wb").close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree("/tmp/catsup-hashing", ignore_errors=True)
+
+    def test_hash_file_matches_hashlib(self):
+        expected = (
+            hashlib.md5(self.data).hexdigest(),
+            hashlib.sha1(self.data).hexdigest(),
+            hashlib.sha512(self.data).hexdigest(),
+        )
+        for block_size in [1, 1000, 65536, hashing.BLOCK_SIZE]:
+            result = hashing.hash_file(
+                "/tmp/catsup-hashing/sample.fastq.gz", block_size=block_size
+            )
+            self.assertEqual(expected, result)
+
+    def test_hash_file_empty(self):
+        expected = (
+            hashlib.md5(b"").hexdigest(),
+            hashlib.sha1(b"").hexdigest(),
+            hashlib.sha512(b"").hexdigest(),
+        )
+        result = hashing.hash_file("/tmp/catsup-hashing/empty.fastq.gz")
+        self.assertEqual(expected, result)
+
+    def test_hash_files_keeps_order(self):
+        filenames = [
+            "/tmp/catsup-hashing/sample.fastq.gz",
+            "/tmp/catsup-hashing/empty.fastq.gz",
+        ] * 5
+        expected = [hashing.hash_file(f) for f in filenames]
+        for workers in [1, 3, 16]:
+            result = hashing.hash_files(filenames, workers=workers)
+            self.assertEqual(expected, result)
+
+    def test_digest_cache_hit(self):
+        filename = "/tmp/catsup-hashing/sample.fastq.gz"
+        cache = hashing.DigestCache("/tmp/catsup-hashing/cache.json")
+        expected = hashing.hash_file(filename, cache=cache)
+        cache.save()
+
+        # overwrite the contents in place, keeping size, mtime and inode
+        st = os.stat(filename)
+        with open(filename, "r+b") as f:
+            f.write(bytes(len(self.data)))
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        # a fresh cache loaded from disk returns the digests without reading
+        cache = hashing.DigestCache("/tmp/catsup-hashing/cache.json")
+        self.assertEqual(expected, hashing.hash_file(filename, cache=cache))
+        self.assertNotEqual(expected, hashing.hash_file(filename))
+
+    def test_digest_cache_invalidated_on_change(self):
+        filename = "/tmp/catsup-hashing/sample.fastq.gz"
+        cache = hashing.DigestCache("/tmp/catsup-hashing/cache.json")
+        hashing.hash_file(filename, cache=cache)
+        with open(filename, "ab") as f:
+            f.write(b"more")
+        expected = (
+            hashlib.md5(self.data + b"more").hexdigest(),
+            hashlib.sha1(self.data + b"more").hexdigest(),
+            hashlib.sha512(self.data + b"more").hexdigest(),
+        )
+        self.assertEqual(expected, hashing.hash_file(filename, cache=cache))
+
+    def test_digest_cache_eviction(self):
+        cache = hashing.DigestCache("/tmp/catsup-hashing/cache.json", max_entries=2)
+        for i in range(4):
+            filename = f"/tmp/catsup-hashing/evict{i}.fastq.gz"
+            with open(filename, "wb") as f:
+                f.write(bytes([i]))
+            hashing.hash_file(filename, cache=cache)
+            cache.save()
+        cache = hashing.DigestCache("/tmp/catsup-hashing/cache.json")
+        self.assertEqual(
+            sorted(cache.entries),
+            ["/tmp/catsup-hashing/evict2.fastq.gz", "/tmp/catsup-hashing/evict3.fastq.gz"],
+        )
+
+    def test_tee_digest_sidecar(self):
+        out_file = "/tmp/catsup-hashing/sample_C1.fastq.gz"
+        subprocess.run(
+            ["python3", "hashing.py", "tee-digest", out_file],
+            input=self.data,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        with open(out_file, "rb") as f:
+            self.assertEqual(self.data, f.read())
+        expected = hashing.hash_file(out_file)
+        self.assertEqual(expected, hashing.read_digests(out_file, "/tmp/catsup-hashing"))
+
+        # a sidecar for a different size is ignored
+        with open(out_file, "ab") as f:
+            f.write(b"truncated upload?")
+        self.assertEqual(None, hashing.read_digests(out_file, "/tmp/catsup-hashing"))
+        self.assertNotEqual(
+            expected, hashing.hash_file(out_file, digest_dir="/tmp/catsup-hashing")
+        )
+
+    @unittest.skipUnless(shutil.which("sha512sum"), "coreutils not installed")
+    def test_hash_file_matches_coreutils(self):
+        filename = "/tmp/catsup-hashing/sample.fastq.gz"
+        expected = tuple(
+            subprocess.check_output([exe, filename]).split()[0].decode()
+            for exe in ["md5sum", "sha1sum", "sha512sum"]
+        )
+        self.assertEqual(expected, hashing.hash_file(filename))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,309 @@
+# Test nanopore.py
+# Run all tests: python3 test-nanopore.py
+# Run one test:  python3 test-nanopore.py TestNanopore.test_concat_gzipped
+
+import gzip
+import os
+import shutil
+import subprocess
+import threading
+import time
+import unittest
+import zlib
+
+import nanopore
+
+
+class TestNanopore(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree("/tmp/catsup-nanopore", ignore_errors=True)
+        os.makedirs("/tmp/catsup-nanopore/run/barcode01")
+        os.makedirs("/tmp/catsup-nanopore/run/barcode02")
+        os.makedirs("/tmp/catsup-nanopore/run/unclassified")
+        os.makedirs("/tmp/catsup-nanopore/out")
+        self.reads = list()
+        for i in range(5):
+            read = f"@read{i}\nACGT\n+\nIIII\n".encode()
+            self.reads.append(read)
+            gz_file = f"/tmp/catsup-nanopore/run/barcode01/{i}.fastq.gz"
+            with gzip.open(gz_file, "wb") as f:
+                f.write(read)
+            with open(f"/tmp/catsup-nanopore/run/barcode02/{i}.fastq", "wb") as f:
+                f.write(read)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree("/tmp/catsup-nanopore", ignore_errors=True)
+
+    def test_is_dir_gzipped(self):
+        self.assertTrue(nanopore.is_dir_gzipped("/tmp/catsup-nanopore/run/barcode01"))
+        self.assertFalse(nanopore.is_dir_gzipped("/tmp/catsup-nanopore/run/barcode02"))
+        self.assertFalse(nanopore.is_dir_gzipped("/tmp/catsup-nanopore/out"))
+
+    def test_concat_gzipped(self):
+        out = "/tmp/catsup-nanopore/out/barcode01.fastq.gz"
+        self.assertEqual(
+            None, nanopore.concat_files("/tmp/catsup-nanopore/run/barcode01", out)
+        )
+        with gzip.open(out) as f:
+            self.assertEqual(b"".join(self.reads), f.read())
+        # running again replaces the output instead of appending to it
+        nanopore.concat_files("/tmp/catsup-nanopore/run/barcode01", out)
+        with gzip.open(out) as f:
+            self.assertEqual(b"".join(self.reads), f.read())
+
+    def test_concat_without_kernel_copy(self):
+        kernel_copies = nanopore.KERNEL_COPIES
+        nanopore.KERNEL_COPIES = []
+        try:
+            out = "/tmp/catsup-nanopore/out/barcode01.fastq.gz"
+            nanopore.concat_files("/tmp/catsup-nanopore/run/barcode01", out)
+        finally:
+            nanopore.KERNEL_COPIES = kernel_copies
+        with gzip.open(out) as f:
+            self.assertEqual(b"".join(self.reads), f.read())
+
+    def test_concat_uncompressed(self):
+        out = "/tmp/catsup-nanopore/out/barcode02.fastq.gz"
+        nanopore.concat_files("/tmp/catsup-nanopore/run/barcode02", out)
+        with gzip.open(out) as f:
+            self.assertEqual(b"".join(self.reads), f.read())
+
+    def test_gzip_files_in_blocks(self):
+        files = list()
+        for i in range(3):
+            files.append(f"/tmp/catsup-nanopore/run/unclassified/{i}.fastq")
+            with open(files[-1], "wb") as f:
+                f.write(os.urandom(50000).hex().encode())
+        out_file = "/tmp/catsup-nanopore/out/unclassified.fastq.gz"
+        with open(out_file, "wb") as out:
+            nanopore.gzip_files(files, out, level=1, threads=4, block_size=30000)
+        expected = b"".join(open(f, "rb").read() for f in files)
+        with gzip.open(out_file) as f:
+            self.assertEqual(expected, f.read())
+        # one member per block
+        with open(out_file, "rb") as f:
+            data = f.read()
+        members = 0
+        while data:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            d.decompress(data)
+            data = d.unused_data
+            members += 1
+        self.assertEqual(10, members)
+        if shutil.which("zcat"):
+            self.assertEqual(expected, subprocess.check_output(["zcat", out_file]))
+
+    def test_concat_errors(self):
+        error = nanopore.concat_files(
+            "/tmp/catsup-nanopore/run/barcode01", "/tmp/catsup-nanopore/nodir/out.gz"
+        )
+        self.assertEqual("concat_failed", error["reason"])
+        error = nanopore.concat_files(
+            "/tmp/catsup-nanopore/out", "/tmp/catsup-nanopore/out/x.fastq.gz"
+        )
+        self.assertEqual("no_files", error["reason"])
+
+    def test_multiplexed_jobs(self):
+        # an empty barcode directory gets no job, rather than a failed one
+        os.makedirs("/tmp/catsup-nanopore/run/barcode03")
+        jobs = nanopore.nanopore_multiplexed_preprocess(
+            "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+        )
+        self.assertEqual(
+            [
+                "/tmp/catsup-nanopore/out/barcode01.fastq.gz",
+                "/tmp/catsup-nanopore/out/barcode02.fastq.gz",
+            ],
+            [job["output"] for job in jobs],
+        )
+        for job in jobs:
+            self.assertEqual(None, nanopore.run_job(job))
+
+    def test_run_jobs(self):
+        jobs = nanopore.nanopore_multiplexed_preprocess(
+            "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+        )
+        jobs.append(
+            {
+                "action": "concat",
+                "input": "/tmp/catsup-nanopore/run/unclassified",
+                "output": "/tmp/catsup-nanopore/out/unclassified.fastq.gz",
+            }
+        )
+        reports = list()
+        errors = nanopore.run_jobs(jobs, workers=3, report=reports.append)
+        self.assertEqual(["unclassified.fastq.gz"], list(errors))
+        self.assertEqual(
+            {
+                "barcode01.fastq.gz": "done",
+                "barcode02.fastq.gz": "done",
+                "unclassified.fastq.gz": "failed",
+            },
+            reports[-1],
+        )
+        self.assertEqual(2 * len(jobs), len(reports))
+
+    def test_append_chunks(self):
+        ledger = nanopore.ChunkLedger("/tmp/catsup-nanopore/ledger.json")
+        job = nanopore.nanopore_multiplexed_preprocess(
+            "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+        )[0]
+        self.assertEqual(5, nanopore.append_chunks(job, ledger, settle=0))
+        self.assertEqual(0, nanopore.append_chunks(job, ledger, settle=0))
+
+        read = b"@read5\nACGT\n+\nIIII\n"
+        with gzip.open("/tmp/catsup-nanopore/run/barcode01/5.fastq.gz", "wb") as f:
+            f.write(read)
+        job = nanopore.nanopore_multiplexed_preprocess(
+            "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+        )[0]
+        # still being written
+        self.assertEqual(0, nanopore.append_chunks(job, ledger, settle=60))
+        # an append was interrupted after the output was written to
+        with open(job["output"], "ab") as f:
+            f.write(b"partial")
+        ledger = nanopore.ChunkLedger("/tmp/catsup-nanopore/ledger.json")
+        self.assertEqual(1, nanopore.append_chunks(job, ledger, settle=0))
+        with gzip.open(job["output"]) as f:
+            self.assertEqual(b"".join(self.reads) + read, f.read())
+
+    def test_run_jobs_resets_ledger(self):
+        ledger = nanopore.ChunkLedger("/tmp/catsup-nanopore/ledger.json")
+        job = nanopore.nanopore_multiplexed_preprocess(
+            "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+        )[1]
+        self.assertEqual(5, nanopore.append_chunks(job, ledger, settle=0))
+        # prepared again without following, into a longer file with more
+        # gzip members, so the old length would fall inside one of them
+        gzip_files = nanopore.gzip_files
+        nanopore.gzip_files = lambda files, out, level, threads: gzip_files(
+            files, out, level, threads, block_size=7
+        )
+        try:
+            self.assertEqual({}, nanopore.run_jobs([job], ledger=ledger))
+        finally:
+            nanopore.gzip_files = gzip_files
+
+        read = b"@read5\nACGT\n+\nIIII\n"
+        with open("/tmp/catsup-nanopore/run/barcode02/5.fastq", "wb") as f:
+            f.write(read)
+        job = nanopore.nanopore_multiplexed_preprocess(
+            "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+        )[1]
+        ledger = nanopore.ChunkLedger("/tmp/catsup-nanopore/ledger.json")
+        self.assertEqual(1, nanopore.append_chunks(job, ledger, settle=0))
+        with gzip.open(job["output"]) as f:
+            self.assertEqual(b"".join(self.reads) + read, f.read())
+
+    def test_follow_run(self):
+        passes = list()
+
+        def make_jobs(final):
+            passes.append(final)
+            return nanopore.nanopore_multiplexed_preprocess(
+                "/tmp/catsup-nanopore/run", "/tmp/catsup-nanopore/out"
+            )
+
+        def sequencer():
+            time.sleep(0.2)
+            os.makedirs("/tmp/catsup-nanopore/run/barcode03")
+            with gzip.open("/tmp/catsup-nanopore/run/barcode03/0.fastq.gz", "wb") as f:
+                f.write(self.reads[0])
+            open("/tmp/catsup-nanopore/final_summary_x.txt", "w").close()
+
+        shutil.rmtree("/tmp/catsup-nanopore/run/barcode02")
+        threading.Thread(target=sequencer).start()
+        reports = list()
+        errors = nanopore.follow_run(
+            make_jobs,
+            "/tmp/catsup-nanopore/run",
+            nanopore.ChunkLedger("/tmp/catsup-nanopore/ledger.json"),
+            interval=0.05,
+            report=reports.append,
+        )
+        self.assertEqual({}, errors)
+        self.assertEqual(["barcode01.fastq.gz"], list(reports[0]))
+        self.assertEqual(
+            {"barcode01.fastq.gz": "done", "barcode03.fastq.gz": "done"}, reports[-1]
+        )
+        with gzip.open("/tmp/catsup-nanopore/out/barcode03.fastq.gz") as f:
+            self.assertEqual(self.reads[0], f.read())
+        self.assertEqual([False, True], [passes[0], passes[-1]])
+
+    def test_follow_run_idle_timeout(self):
+        start = time.monotonic()
+        errors = nanopore.follow_run(
+            lambda final: [],
+            "/tmp/catsup-nanopore/run",
+            nanopore.ChunkLedger("/tmp/catsup-nanopore/ledger.json"),
+            interval=0.05,
+            idle_timeout=0.2,
+        )
+        self.assertEqual({}, errors)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def age_run_dirs(self):
+        # as if the run directories were last changed a while ago
+        old = time.time() - 60
+        for directory in ["", "barcode01", "barcode02", "unclassified"]:
+            os.utime(f"/tmp/catsup-nanopore/run/{directory}", (old, old))
+
+    def test_inventory(self):
+        self.age_run_dirs()
+        inventory = nanopore.Inventory("/tmp/catsup-nanopore/run").refresh()
+        self.assertEqual(
+            ["barcode01", "barcode02", "unclassified"], inventory.subdirs()
+        )
+        entry = inventory.dirs["barcode02"]["files"][0]
+        self.assertEqual(
+            ("0.fastq", len(self.reads[0]), ".fastq", "barcode02"),
+            (entry["name"], entry["size"], entry["suffix"], entry["barcode"]),
+        )
+        inventory.save("/tmp/catsup-nanopore/inventory.json")
+        inventory = nanopore.Inventory.load(
+            "/tmp/catsup-nanopore/inventory.json", "/tmp/catsup-nanopore/run"
+        )
+
+        # only directories that changed are listed again
+        scanned = list()
+        scan_dir = nanopore.scan_dir
+
+        def counting_scan_dir(directory, barcode=None):
+            scanned.append(barcode)
+            return scan_dir(directory, barcode)
+
+        nanopore.scan_dir = counting_scan_dir
+        try:
+            time.sleep(0.01)
+            open("/tmp/catsup-nanopore/run/barcode02/5.fastq", "w").close()
+            shutil.rmtree("/tmp/catsup-nanopore/run/unclassified")
+            inventory.refresh()
+        finally:
+            nanopore.scan_dir = scan_dir
+        self.assertEqual([None, "barcode02"], scanned)
+        self.assertEqual(6, len(inventory.files("barcode02")))
+        self.assertEqual(["barcode01", "barcode02"], sorted(inventory.dirs)[1:])
+
+    def test_inventory_coarse_mtime(self):
+        barcode01 = "/tmp/catsup-nanopore/run/barcode01"
+        inventory = nanopore.Inventory("/tmp/catsup-nanopore/run").refresh()
+        # a chunk written in the same mtime tick as the listing
+        mtime_ns = os.stat(barcode01).st_mtime_ns
+        open(f"{barcode01}/5.fastq.gz", "w").close()
+        os.utime(barcode01, ns=(mtime_ns, mtime_ns))
+        self.assertEqual(6, len(inventory.refresh().files("barcode01")))
+
+        # a listing taken well after the last change is trusted, unless
+        # the whole run directory is listed again
+        self.age_run_dirs()
+        inventory.refresh()
+        mtime_ns = os.stat(barcode01).st_mtime_ns
+        open(f"{barcode01}/6.fastq.gz", "w").close()
+        os.utime(barcode01, ns=(mtime_ns, mtime_ns))
+        self.assertEqual(6, len(inventory.refresh().files("barcode01")))
+        self.assertEqual(7, len(inventory.refresh(full=True).files("barcode01")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,335 @@
+# Test par_upload.py against a local stand-in for an object storage PAR
+# Run all tests: python3 test-par_upload.py
+# Run one test:  python3 test-par_upload.py TestParUpload.test_upload_run
+
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import threading
+import unittest
+
+import par_upload
+import retry
+import throttle
+
+
+class ObjectStoreHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.clients.add(self.client_address)
+        if self.path in self.server.drop_paths:
+            # hang up without a response, like a server closing a connection
+            self.server.drop_paths.remove(self.path)
+            self.close_connection = True
+            return
+        if self.path in self.server.fail_paths:
+            return self.reply(self.server.fail_status)
+        if self.headers.get("opc-multipart") == "true":
+            # create a multipart upload, like an object storage PAR does
+            upload_id = str(len(self.server.uploads))
+            self.server.uploads[upload_id] = (self.path, dict())
+            access_uri = f"/p/par/u/{upload_id}/"
+            return self.reply(200, json.dumps({"accessUri": access_uri}).encode())
+        if self.path.startswith("/p/par/u/"):
+            upload_id, part_num = self.path.split("/")[4:6]
+            if upload_id not in self.server.uploads:
+                return self.reply(404)
+            self.server.part_puts.append(int(part_num))
+            self.server.uploads[upload_id][1][int(part_num)] = body
+            return self.reply(200)
+        self.server.objects[self.path] = body
+        self.reply(200)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        upload_id = self.path.split("/")[4]
+        if upload_id not in self.server.uploads:
+            return self.reply(404)
+        path, parts = self.server.uploads.pop(upload_id)
+        self.server.objects[path] = b"".join(parts[k] for k in sorted(parts))
+        self.reply(200)
+
+    def do_DELETE(self):
+        upload_id = self.path.split("/")[4]
+        self.server.uploads.pop(upload_id, None)
+        self.reply(204)
+
+
+class ObjectStore(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ObjectStoreHandler)
+        self.objects = dict()
+        self.uploads = dict()
+        self.part_puts = list()
+        self.clients = set()
+        self.fail_paths = set()
+        self.drop_paths = set()
+        self.fail_status = 500
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/p/par/o/"
+
+
+class CountingProgress:
+    def __init__(self, sent):
+        self.sent = sent
+
+    def add(self, name, nbytes):
+        self.sent.append(nbytes)
+
+
+class CountingLimiter:
+    def __init__(self, consumed):
+        self.consumed = consumed
+
+    def consume(self, key, nbytes):
+        self.consumed.append(nbytes)
+
+
+class TestParUpload(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree("/tmp/catsup-par", ignore_errors=True)
+        os.makedirs("/tmp/catsup-par/upload")
+        self.files = {
+            "sub_C1.fastq.gz": os.urandom(3 * par_upload.BLOCK_SIZE + 5),
+            "sub_C2.fastq.gz": os.urandom(1000),
+            "sp3data.csv": b"submission_uuid4,sample_uuid4\nsubuuid,sampleuuid\n",
+        }
+        for name, data in self.files.items():
+            with open(f"/tmp/catsup-par/upload/{name}", "wb") as f:
+                f.write(data)
+
+        self.store = ObjectStore()
+        threading.Thread(target=self.store.serve_forever, daemon=True).start()
+        self.policy = par_upload.POLICY
+        self.limiter = throttle.LIMITER
+        par_upload.POOL.close()
+
+    def tearDown(self):
+        par_upload.POOL.close()
+        par_upload.POLICY = self.policy
+        throttle.LIMITER = self.limiter
+        self.store.shutdown()
+        self.store.server_close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree("/tmp/catsup-par", ignore_errors=True)
+
+    def test_upload_run(self):
+        error = par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.assertEqual(None, error)
+        for name, data in self.files.items():
+            self.assertEqual(data, self.store.objects[f"/p/par/o/subuuid/{name}"])
+        self.assertEqual(b"", self.store.objects["/p/par/o/subuuid/upload_done.txt"])
+
+    def test_upload_run_concurrent(self):
+        error = par_upload.upload_run(self.store.url, "/tmp/catsup-par", workers=3)
+        self.assertEqual(None, error)
+        for name, data in self.files.items():
+            self.assertEqual(data, self.store.objects[f"/p/par/o/subuuid/{name}"])
+        self.assertIn("/p/par/o/subuuid/upload_done.txt", self.store.objects)
+
+    def test_connection_reused(self):
+        par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.assertEqual(1, len(self.store.clients))
+
+    def test_stale_connection(self):
+        par_upload.upload_file(
+            self.store.url, "/tmp/catsup-par/upload/sp3data.csv", "subuuid"
+        )
+        # the server drops the idle connection
+        for conns in par_upload.POOL.idle.values():
+            for conn in conns:
+                conn.sock.shutdown(2)
+        error = par_upload.upload_file(
+            self.store.url, "/tmp/catsup-par/upload/sub_C1.fastq.gz", "subuuid"
+        )
+        self.assertEqual(None, error)
+        self.assertEqual(
+            self.files["sub_C1.fastq.gz"],
+            self.store.objects["/p/par/o/subuuid/sub_C1.fastq.gz"],
+        )
+
+    def test_stale_connection_progress(self):
+        par_upload.upload_file(
+            self.store.url, "/tmp/catsup-par/upload/sp3data.csv", "subuuid"
+        )
+        # the body is sent in full before the server hangs up
+        self.store.drop_paths.add("/p/par/o/subuuid/sub_C2.fastq.gz")
+        sent = list()
+        throttled = list()
+        throttle.LIMITER = CountingLimiter(throttled)
+        error = par_upload.upload_file(
+            self.store.url,
+            "/tmp/catsup-par/upload/sub_C2.fastq.gz",
+            "subuuid",
+            progress=CountingProgress(sent),
+        )
+        self.assertEqual(None, error)
+        self.assertEqual(len(self.files["sub_C2.fastq.gz"]), sum(sent))
+        # but the throttle is told about both attempts
+        self.assertEqual(2 * len(self.files["sub_C2.fastq.gz"]), sum(throttled))
+
+    def test_upload_error(self):
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=1)
+        self.store.fail_paths.add("/p/par/o/subuuid/sub_C2.fastq.gz")
+        self.store.fail_paths.add("/p/par/o/subuuid/sp3data.csv")
+        error = par_upload.upload_run(self.store.url, "/tmp/catsup-par", workers=3)
+        self.assertIn("HTTP 500", error["error_exception_str"])
+        self.assertEqual(1, len(error["attempts"]))
+        self.assertEqual(
+            ["sp3data.csv", "sub_C2.fastq.gz"], sorted(error["failed_files"])
+        )
+        self.assertIn(
+            "sub_C2.fastq.gz", error["failed_files"]["sub_C2.fastq.gz"]["error_command"]
+        )
+        # the other files still landed, but the submission isn't marked done
+        self.assertIn("/p/par/o/subuuid/sub_C1.fastq.gz", self.store.objects)
+        self.assertNotIn("/p/par/o/subuuid/upload_done.txt", self.store.objects)
+
+    def test_multipart_upload(self):
+        part_size = par_upload.BLOCK_SIZE
+        error = par_upload.upload_run(
+            self.store.url,
+            "/tmp/catsup-par",
+            multipart_threshold=2 * part_size,
+            part_size=part_size,
+        )
+        self.assertEqual(None, error)
+        for name, data in self.files.items():
+            self.assertEqual(data, self.store.objects[f"/p/par/o/subuuid/{name}"])
+        self.assertEqual([1, 2, 3, 4], self.store.part_puts)
+        self.assertEqual([], os.listdir("/tmp/catsup-par/.par_multipart"))
+
+    def test_multipart_upload_resumes(self):
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=1)
+        u_file = "/tmp/catsup-par/upload/sub_C1.fastq.gz"
+        self.store.fail_paths.add("/p/par/u/0/3")
+        error = par_upload.upload_file(
+            self.store.url, u_file, "subuuid", multipart_threshold=2000, part_size=500000
+        )
+        self.assertIn("HTTP 500", error["error_exception_str"])
+        self.assertEqual([1, 2], self.store.part_puts)
+
+        # a new process picks up the recorded parts and only sends the rest
+        self.store.fail_paths.clear()
+        par_upload.POOL.close()
+        error = par_upload.upload_file(
+            self.store.url, u_file, "subuuid", multipart_threshold=2000, part_size=500000
+        )
+        self.assertEqual(None, error)
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7], self.store.part_puts)
+        self.assertEqual(
+            self.files["sub_C1.fastq.gz"],
+            self.store.objects["/p/par/o/subuuid/sub_C1.fastq.gz"],
+        )
+
+    def test_multipart_upload_restarts_expired(self):
+        u_file = "/tmp/catsup-par/upload/sub_C2.fastq.gz"
+        self.store.fail_paths.add("/p/par/u/0/2")
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=1)
+        par_upload.upload_file(
+            self.store.url, u_file, "subuuid", multipart_threshold=100, part_size=400
+        )
+        # the upload expires on the server
+        self.store.fail_paths.clear()
+        self.store.uploads.clear()
+        error = par_upload.upload_file(
+            self.store.url, u_file, "subuuid", multipart_threshold=100, part_size=400
+        )
+        self.assertIn("HTTP 404", error["error_exception_str"])
+        error = par_upload.upload_file(
+            self.store.url, u_file, "subuuid", multipart_threshold=100, part_size=400
+        )
+        self.assertEqual(None, error)
+        self.assertEqual(
+            self.files["sub_C2.fastq.gz"],
+            self.store.objects["/p/par/o/subuuid/sub_C2.fastq.gz"],
+        )
+
+    def test_multipart_create_not_found(self):
+        # the PAR itself is gone, so no multipart state was ever saved
+        u_file = "/tmp/catsup-par/upload/sub_C2.fastq.gz"
+        self.store.fail_paths.add("/p/par/o/subuuid/sub_C2.fastq.gz")
+        self.store.fail_status = 404
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=1)
+        error = par_upload.upload_file(
+            self.store.url, u_file, "subuuid", multipart_threshold=100, part_size=400
+        )
+        self.assertIn("HTTP 404", error["error_exception_str"])
+
+    def test_journal_skips_uploaded_files(self):
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=1)
+        self.store.fail_paths.add("/p/par/o/subuuid/sub_C2.fastq.gz")
+        error = par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.assertIn("sub_C2.fastq.gz", error["failed_files"])
+
+        # only the file that failed is sent again
+        self.store.fail_paths.clear()
+        self.store.objects.clear()
+        error = par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.assertEqual(None, error)
+        self.assertEqual(
+            ["/p/par/o/subuuid/sub_C2.fastq.gz", "/p/par/o/subuuid/upload_done.txt"],
+            sorted(self.store.objects),
+        )
+
+        # nothing is sent when everything has landed
+        self.store.objects.clear()
+        self.assertEqual(None, par_upload.upload_run(self.store.url, "/tmp/catsup-par"))
+        self.assertEqual({}, self.store.objects)
+
+    def test_journal_changed_file(self):
+        par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.store.objects.clear()
+        with open("/tmp/catsup-par/upload/sub_C2.fastq.gz", "wb") as f:
+            f.write(b"new contents")
+        par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.assertEqual(
+            b"new contents", self.store.objects["/p/par/o/subuuid/sub_C2.fastq.gz"]
+        )
+        self.assertIn("/p/par/o/subuuid/upload_done.txt", self.store.objects)
+        self.assertEqual(2, len(self.store.objects))
+
+    def test_journal_new_destination(self):
+        par_upload.upload_run(self.store.url, "/tmp/catsup-par")
+        self.store.objects.clear()
+        par_upload.upload_run(self.store.url + "other/", "/tmp/catsup-par")
+        self.assertEqual(len(self.files) + 1, len(self.store.objects))
+
+    def test_retry_attempts_recorded(self):
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=3, base_delay=0.01)
+        self.store.fail_paths.add("/p/par/o/subuuid/sub_C2.fastq.gz")
+        error = par_upload.upload_file(
+            self.store.url, "/tmp/catsup-par/upload/sub_C2.fastq.gz", "subuuid"
+        )
+        self.assertEqual([1, 2, 3], [x["attempt"] for x in error["attempts"]])
+        self.assertEqual(0, error["attempts"][-1]["sleep"])
+
+    def test_client_error_not_retried(self):
+        par_upload.POLICY = retry.RetryPolicy(max_attempts=5, base_delay=0.01)
+        self.store.fail_paths.add("/p/par/o/subuuid/sub_C2.fastq.gz")
+        self.store.fail_status = 403
+        error = par_upload.upload_file(
+            self.store.url, "/tmp/catsup-par/upload/sub_C2.fastq.gz", "subuuid"
+        )
+        self.assertEqual(1, len(error["attempts"]))
+        self.assertIn("HTTP 403", error["error_exception_str"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# Test progress.py
+# Run all tests: python3 test-progress.py
+# Run one test:  python3 test-progress.py TestProgress.test_status
+
+import os
+import shutil
+import time
+import unittest
+
+import progress
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree("/tmp/catsup-progress", ignore_errors=True)
+        os.makedirs("/tmp/catsup-progress")
+        self.path = "/tmp/catsup-progress/.step4-progress.json"
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree("/tmp/catsup-progress", ignore_errors=True)
+
+    def test_status(self):
+        tracker = progress.UploadProgress(self.path, interval=0)
+        tracker.add_file("a", 1000)
+        tracker.add_file("b", 3000)
+        tracker.start_file("a")
+        tracker.add("a", 500)
+        time.sleep(0.1)
+        tracker.add("a", 500)
+        tracker.finish_file("a", True)
+
+        status = progress.read_progress(self.path)
+        self.assertEqual(1000, status["bytes_sent"])
+        self.assertEqual(4000, status["bytes_total"])
+        # 500 bytes in about 0.1 seconds
+        self.assertAlmostEqual(5000, status["throughput"], delta=1500)
+        self.assertAlmostEqual(0.6, status["eta"], delta=0.5)
+        self.assertEqual([1000, 1000, "done"], status["files"]["a"])
+        self.assertEqual([0, 3000, "queued"], status["files"]["b"])
+
+    def test_retry_not_counted_twice(self):
+        tracker = progress.UploadProgress(self.path)
+        tracker.add_file("a", 1000)
+        tracker.add("a", 800)
+        tracker.add("a", 800)
+        tracker.finish_file("a", False)
+        status = progress.read_progress(self.path)
+        self.assertEqual([1000, 1000, "failed"], status["files"]["a"])
+
+    def test_no_throughput_yet(self):
+        tracker = progress.UploadProgress(self.path)
+        tracker.add_file("a", 1000)
+        tracker.write()
+        status = progress.read_progress(self.path)
+        self.assertEqual(0, status["throughput"])
+        self.assertEqual(None, status["eta"])
+
+    def test_read_missing(self):
+        self.assertEqual(None, progress.read_progress("/tmp/catsup-progress/nope"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+# Test readset.py
+# Run all tests: python3 test-readset.py
+# Run one test:  python3 test-readset.py TestReadSet.test_chunks
+
+import unittest
+
+import readset
+
+
+class TestReadSet(unittest.TestCase):
+    def test_contains(self):
+        read_ids = [b"read%d" % i for i in range(0, 1000, 2)]
+        s = readset.ReadSet.from_ids(read_ids)
+        self.assertEqual(500, len(s))
+        self.assertEqual(4000, s.nbytes())
+        for i in range(1000):
+            self.assertEqual(i % 2 == 0, b"read%d" % i in s)
+
+    def test_chunks(self):
+        read_ids = [b"read%d" % i for i in range(1000)]
+        s = readset.ReadSet.from_ids(iter(read_ids), chunk_size=7)
+        self.assertEqual(sorted(s.fingerprints), list(s.fingerprints))
+        self.assertTrue(all(x in s for x in read_ids))
+        self.assertNotIn(b"read1000", s)
+
+    def test_empty(self):
+        s = readset.ReadSet.from_ids([])
+        self.assertEqual(0, len(s))
+        self.assertNotIn(b"read", s)
+
+
+if __name__ == "__main__":
+    unittest.main()
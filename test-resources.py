@@ -0,0 +1,108 @@
+# Test resources.py
+# Run all tests: python3 test-resources.py
+# Run one test:  python3 test-resources.py TestResources.test_plan
+
+import pathlib
+import tempfile
+import unittest
+
+import resources
+
+GB = resources.GB
+MB = resources.MB
+
+
+class TestResources(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self.tmp.name)
+        self.input_dir = self.dir / "pipeline_in"
+        self.input_dir.mkdir()
+        self.db = self.dir / "db"
+        self.db.mkdir()
+        with open(self.db / "hash.k2d", "wb") as f:
+            f.truncate(4 * GB)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add_sample(self, name, size):
+        for n in ["1", "2"]:
+            with open(self.input_dir / f"{name}_{n}.fastq.gz", "wb") as f:
+                f.truncate(size // 2)
+
+    def test_path_size(self):
+        self.assertEqual(4 * GB, resources.path_size(self.db))
+        self.assertEqual(4 * GB, resources.path_size(self.db / "hash.k2d"))
+        for n in ["1", "2"]:
+            (self.dir / f"hg38.{n}.cf").write_bytes(b"x" * 10)
+        self.assertEqual(20, resources.path_size(self.dir / "hg38"))
+
+    def test_sample_sizes(self):
+        self.add_sample("a", 10)
+        self.add_sample("b", 20)
+        (self.input_dir / "c_1.fastq.gz").write_bytes(b"x")
+        self.assertEqual(
+            {"a": 10, "b": 20, "c": 1}, resources.sample_sizes(self.input_dir)
+        )
+
+    def test_plan(self):
+        for i in range(4):
+            self.add_sample(f"s{i}", 16 * GB)
+        executor, processes = resources.plan(self.input_dir, self.db, 16, 33 * GB)
+        self.assertEqual({"cpus": 16, "memory": 32 * GB}, executor)
+        # 5.4 GB per classifier, 4 samples all fit
+        self.assertEqual(4, processes["classification"]["cpus"])
+        self.assertEqual(int(4 * GB * 1.1 + GB), processes["classification"]["memory"])
+        self.assertEqual({"cpus": 1, "memory": 2 * GB}, processes["trim"])
+        self.assertEqual(2, processes["removal"]["cpus"])
+
+        # on a small host only one classifier fits, and gets all the cores
+        executor, processes = resources.plan(self.input_dir, self.db, 4, 7 * GB)
+        self.assertEqual(4, processes["classification"]["cpus"])
+        # the database doesn't fit, but a classifier can't run in less
+        executor, processes = resources.plan(self.input_dir, self.db, 4, 4 * GB)
+        self.assertEqual(int(4 * GB * 1.1 + GB), processes["classification"]["memory"])
+        self.assertEqual(processes["classification"]["memory"], executor["memory"])
+
+    def test_plan_not_local(self):
+        self.add_sample("s", 64 * GB)
+        executor, processes = resources.plan(self.input_dir, self.db, local=False)
+        self.assertEqual(None, executor)
+        # not bounded by the memory of the host
+        self.assertEqual(5 * GB, processes["trim"]["memory"])
+        self.assertEqual(None, processes["classification"]["cpus"])
+        self.assertEqual(int(4 * GB * 1.1 + GB), processes["classification"]["memory"])
+
+        config = self.dir / "resources.config"
+        resources.write_config(config, executor, processes)
+        text = config.read_text()
+        self.assertNotIn("executor", text)
+        self.assertEqual(2, text.count("cpus ="))
+        self.assertEqual(3, text.count("memory ="))
+        self.assertEqual(text.count("{"), text.count("}"))
+
+    def test_is_local_executor(self):
+        for params, expected in [
+            ("", True),
+            (None, True),
+            ("-resume", True),
+            ("-process.executor local", True),
+            ("-process.executor slurm", False),
+            ("-resume -process.executor=sge", False),
+        ]:
+            self.assertEqual(expected, resources.is_local_executor(params), params)
+
+    def test_write_config(self):
+        self.add_sample("s", GB)
+        config = self.dir / "resources.config"
+        plan = resources.plan(self.input_dir, self.db, 8, 9 * GB)
+        resources.write_config(config, *plan)
+        text = config.read_text()
+        self.assertIn("memory = '8192 MB'", text)
+        self.assertIn("withName: 'contam_removal.*' {", text)
+        self.assertEqual(text.count("{"), text.count("}"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+# Test retry.py
+# Run all tests: python3 test-retry.py
+# Run one test:  python3 test-retry.py TestRetry.test_circuit_breaker
+
+import time
+import unittest
+
+import retry
+
+
+class Failing:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise Exception(f"failure {self.calls}")
+
+
+def quiet(msg):
+    pass
+
+
+class TestRetry(unittest.TestCase):
+    def test_delay_is_capped_and_jittered(self):
+        policy = retry.RetryPolicy(base_delay=1, max_delay=10)
+        for attempt in range(1, 20):
+            delays = [policy.delay(attempt) for _ in range(50)]
+            self.assertTrue(all(0 <= d <= min(10, 2 ** attempt) for d in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_success_after_failures(self):
+        policy = retry.RetryPolicy(max_attempts=5, base_delay=0.001)
+        fn = Failing(2)
+        self.assertEqual(None, retry.call(fn, policy, log=quiet))
+        self.assertEqual(3, fn.calls)
+
+    def test_attempts_recorded(self):
+        policy = retry.RetryPolicy(max_attempts=3, base_delay=0.001)
+        attempts = retry.call(Failing(10), policy, log=quiet)
+        self.assertEqual([1, 2, 3], [x["attempt"] for x in attempts])
+        self.assertEqual("failure 3", attempts[-1]["error"])
+
+    def test_not_retryable(self):
+        policy = retry.RetryPolicy(max_attempts=5, base_delay=0.001)
+        fn = Failing(10)
+        attempts = retry.call(fn, policy, retryable=lambda e: False, log=quiet)
+        self.assertEqual(1, len(attempts))
+        self.assertEqual(1, fn.calls)
+
+    def test_file_deadline(self):
+        policy = retry.RetryPolicy(
+            max_attempts=1000, base_delay=0.05, max_delay=0.05, file_deadline=0.3
+        )
+        start = time.monotonic()
+        attempts = retry.call(Failing(1000), policy, log=quiet)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLess(len(attempts), 1000)
+
+    def test_submission_deadline(self):
+        policy = retry.RetryPolicy(max_attempts=1000, base_delay=1, max_delay=1)
+        deadline = retry.Deadline(0)
+        attempts = retry.call(Failing(1000), policy, deadline=deadline, log=quiet)
+        self.assertEqual(1, len(attempts))
+
+    def test_circuit_breaker(self):
+        breaker = retry.CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        self.assertEqual("closed", breaker.state())
+        breaker.failure()
+        self.assertEqual(0, breaker.wait_time())
+        breaker.failure()
+        self.assertEqual("open", breaker.state())
+        self.assertGreater(breaker.wait_time(), 0)
+
+        time.sleep(0.25)
+        self.assertEqual("half-open", breaker.state())
+        # one probe is let through, everyone else keeps waiting
+        self.assertEqual(0, breaker.wait_time())
+        self.assertGreater(breaker.wait_time(), 0)
+        breaker.failure()
+        self.assertEqual("open", breaker.state())
+
+        time.sleep(0.25)
+        self.assertEqual(0, breaker.wait_time())
+        breaker.success()
+        self.assertEqual("closed", breaker.state())
+        self.assertEqual(0, breaker.wait_time())
+
+    def test_circuit_breaker_gives_up_at_deadline(self):
+        policy = retry.RetryPolicy(max_attempts=1000, base_delay=0.001)
+        breaker = retry.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        fn = Failing(1000)
+        attempts = retry.call(
+            fn, policy, deadline=retry.Deadline(1), breaker=breaker, log=quiet
+        )
+        self.assertEqual(1, fn.calls)
+        self.assertIn("circuit breaker", attempts[-1]["error"])
+
+    def test_circuit_breaker_not_retryable_probe(self):
+        policy = retry.RetryPolicy(max_attempts=1, base_delay=0.001)
+        breaker = retry.CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+        retry.call(Failing(1), policy, breaker=breaker, log=quiet)
+        self.assertEqual("open", breaker.state())
+        time.sleep(0.15)
+        # the probe is refused for good, eg. HTTP 403 from an expired PAR
+        attempts = retry.call(
+            Failing(1), policy, breaker=breaker, retryable=lambda e: False, log=quiet
+        )
+        self.assertEqual(1, len(attempts))
+        start = time.monotonic()
+        self.assertEqual(None, retry.call(Failing(0), policy, breaker=breaker))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual("closed", breaker.state())
+
+    def test_get_breaker_is_shared(self):
+        self.assertIs(retry.get_breaker("host-a"), retry.get_breaker("host-a"))
+        self.assertIsNot(retry.get_breaker("host-a"), retry.get_breaker("host-b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# Test stream_upload.py
+# Run all tests: python3 test-stream_upload.py
+# Run one test:  python3 test-stream_upload.py TestStreamUpload.test_partial_file_waits
+
+import os
+import pathlib
+import shutil
+import threading
+import unittest
+
+import hashing
+import par_upload
+import stream_upload
+
+
+def publish(name, data, sidecar=True):
+    with open(f"/tmp/catsup-stream/upload/{name}", "wb") as f:
+        f.write(data)
+    if sidecar:
+        digests = hashing.hash_file(f"/tmp/catsup-stream/upload/{name}")
+        hashing.write_digests(
+            f"/tmp/catsup-stream/upload_digests/{name}", len(data), digests
+        )
+
+
+class TestStreamUpload(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree("/tmp/catsup-stream", ignore_errors=True)
+        os.makedirs("/tmp/catsup-stream/upload")
+        os.makedirs("/tmp/catsup-stream/upload_digests")
+        self.uploaded = list()
+        self.lock = threading.Lock()
+        self.journal = par_upload.open_journal("/tmp/catsup-stream/upload", "dest")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree("/tmp/catsup-stream", ignore_errors=True)
+
+    def upload_fn(self, u_file):
+        with self.lock:
+            self.uploaded.append(pathlib.Path(u_file).name)
+
+    def streamer(self):
+        return stream_upload.StreamingUploader(
+            "/tmp/catsup-stream/upload",
+            "/tmp/catsup-stream/upload_digests",
+            ["a_C1.fastq.gz", "b_C1.fastq.gz"],
+            self.journal,
+            self.upload_fn,
+            workers=2,
+            interval=0.01,
+        )
+
+    def test_uploads_published_files(self):
+        streamer = self.streamer()
+        streamer.start()
+        publish("a_C1.fastq.gz", b"a" * 1000)
+        publish("b_C1.fastq.gz", b"b" * 1000)
+        self.assertEqual({}, streamer.finish())
+        self.assertEqual(["a_C1.fastq.gz", "b_C1.fastq.gz"], sorted(self.uploaded))
+        for name in self.uploaded:
+            self.assertTrue(self.journal.is_done(f"/tmp/catsup-stream/upload/{name}"))
+
+    def test_partial_file_waits(self):
+        publish("a_C1.fastq.gz", b"a" * 1000)
+        # still being copied into upload/
+        with open("/tmp/catsup-stream/upload/a_C1.fastq.gz", "r+b") as f:
+            f.truncate(500)
+        # no sidecar yet
+        publish("b_C1.fastq.gz", b"b" * 1000, sidecar=False)
+        streamer = self.streamer()
+        streamer.scan()
+        self.assertEqual([], self.uploaded)
+        self.assertEqual(["a_C1.fastq.gz", "b_C1.fastq.gz"], streamer.pending)
+        publish("a_C1.fastq.gz", b"a" * 1000)
+        streamer.finish()
+        self.assertEqual(["a_C1.fastq.gz"], self.uploaded)
+
+    def test_failed_upload(self):
+        streamer = self.streamer()
+        streamer.upload_fn = lambda u_file: {"error_exception_str": "HTTP 500"}
+        publish("a_C1.fastq.gz", b"a" * 1000)
+        errors = streamer.finish()
+        self.assertEqual(["a_C1.fastq.gz"], list(errors))
+        self.assertFalse(self.journal.is_done("/tmp/catsup-stream/upload/a_C1.fastq.gz"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# Test throttle.py
+# Run all tests: python3 test-throttle.py
+# Run one test:  python3 test-throttle.py TestThrottle.test_rate_is_split
+
+import threading
+import time
+import unittest
+
+import throttle
+
+
+def send(limiter, key, nbytes, block_size):
+    for _ in range(nbytes // block_size):
+        limiter.consume(key, block_size)
+
+
+class TestThrottle(unittest.TestCase):
+    def test_unlimited(self):
+        limiter = throttle.BandwidthLimiter()
+        start = time.monotonic()
+        with limiter.activate("sub1"):
+            send(limiter, "sub1", 10 ** 9, 10 ** 6)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_rate(self):
+        limiter = throttle.BandwidthLimiter(rate=1000000)
+        start = time.monotonic()
+        with limiter.activate("sub1"):
+            send(limiter, "sub1", 500000, 50000)
+        self.assertAlmostEqual(0.5, time.monotonic() - start, delta=0.15)
+
+    def test_rate_is_split(self):
+        limiter = throttle.BandwidthLimiter(rate=1000000)
+        durations = dict()
+
+        def submission(key):
+            start = time.monotonic()
+            send(limiter, key, 250000, 25000)
+            durations[key] = time.monotonic() - start
+
+        with limiter.activate("sub1"), limiter.activate("sub2"):
+            self.assertEqual(500000, limiter.share())
+            threads = [
+                threading.Thread(target=submission, args=(key,))
+                for key in ["sub1", "sub2"]
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertAlmostEqual(0.5, durations["sub1"], delta=0.15)
+        self.assertAlmostEqual(0.5, durations["sub2"], delta=0.15)
+        self.assertEqual(1000000, limiter.share())
+
+    def test_mbps_to_bytes(self):
+        self.assertEqual(125000, throttle.mbps_to_bytes(1))
+        self.assertEqual(None, throttle.mbps_to_bytes(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -243,6 +243,64 @@ class TestValidate(unittest.TestCase):
         result = validate.validate_config(input_dict)
         self.assertEqual(expected_results, result)
 
+    def test_validate_config_upload_retry(self):
+        input_data = """
+            {"number_of_example_samples": 1,
+            "pipeline": "catsup-kraken2",
+            "nextflow_additional_params": "",
+            "pipelines": {
+            "catsup-kraken2":
+            {
+                "script": "/tmp/catsup/catsup-kraken2.nf",
+                "image": "/tmp/catsup/fatos.img",
+                "kraken2_human_ref": "/tmp/catsup/human_ref"
+            }},
+            "upload_retry":
+            {
+                "max_attempts": 3,
+                "base_delay": 0.5,
+                "file_deadline": null,
+                "submission_deadline": 3600
+            }}
+            """
+
+        input_dict = json.loads(input_data)
+        self.assertEqual(True, validate.validate_config(input_dict))
+        for k, v in [
+            ("max_attempts", "3"),
+            ("max_attempts", 0),
+            ("breaker_failures", 2.5),
+            ("base_delay", -1),
+            ("max_delay", "300"),
+            ("file_deadline", 0),
+            ("submission_deadline", "1h"),
+        ]:
+            bad = json.loads(input_data)
+            bad["upload_retry"][k] = v
+            self.assertEqual(False, validate.validate_config(bad), k)
+
+    def test_validate_config_digest_cache(self):
+        input_data = """
+            {"number_of_example_samples": 1,
+            "pipeline": "catsup-kraken2",
+            "nextflow_additional_params": "",
+            "pipelines": {
+            "catsup-kraken2":
+            {
+                "script": "/tmp/catsup/catsup-kraken2.nf",
+                "image": "/tmp/catsup/fatos.img",
+                "kraken2_human_ref": "/tmp/catsup/human_ref"
+            }},
+            "digest_cache": {"path": "digest_cache.json", "max_entries": 100}}
+            """
+
+        input_dict = json.loads(input_data)
+        self.assertEqual(True, validate.validate_config(input_dict))
+        for v in ["100", 0, 2.5]:
+            bad = json.loads(input_data)
+            bad["digest_cache"]["max_entries"] = v
+            self.assertEqual(False, validate.validate_config(bad), v)
+
     def test_validate_config_fullconfig(self):
         input_data = """
                 {"number_of_example_samples": 1,
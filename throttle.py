@@ -0,0 +1,91 @@
+"""
+Upload bandwidth limiting.
+
+One BandwidthLimiter (LIMITER) is shared by every upload started in the
+process, so several submissions uploading at once from the web UI stay
+within one budget. The budget is split evenly between the submissions
+that are currently uploading, each of which has its own token bucket.
+"""
+
+import contextlib
+import threading
+import time
+
+
+class BandwidthLimiter:
+    def __init__(self, rate=None, burst_seconds=1.0):
+        """
+        rate is in bytes per second, None means unlimited
+        """
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.lock = threading.Lock()
+        self.active = dict()
+        self.buckets = dict()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+
+    def share(self):
+        """
+        Bytes per second that each active submission may use
+        """
+        with self.lock:
+            return self._share()
+
+    def _share(self):
+        if not self.rate:
+            return None
+        return self.rate / max(1, len(self.active))
+
+    @contextlib.contextmanager
+    def activate(self, key):
+        """
+        Count key as an active submission for the duration of the block
+        """
+        with self.lock:
+            self.active[key] = self.active.get(key, 0) + 1
+            if key not in self.buckets:
+                self.buckets[key] = [0.0, time.monotonic()]
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[key] -= 1
+                if not self.active[key]:
+                    del self.active[key]
+                    del self.buckets[key]
+
+    def consume(self, key, nbytes):
+        """
+        Block until key may send nbytes more
+        """
+        with self.lock:
+            share = self._share()
+            if not share:
+                return
+            bucket = self.buckets.setdefault(key, [0.0, time.monotonic()])
+            now = time.monotonic()
+            tokens = min(
+                share * self.burst_seconds, bucket[0] + (now - bucket[1]) * share
+            )
+            # go into debt and sleep it off, so that concurrent callers
+            # queue up behind each other instead of all waking at once
+            bucket[0] = tokens - nbytes
+            bucket[1] = now
+            wait = -bucket[0] / share if bucket[0] < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+LIMITER = BandwidthLimiter()
+
+
+def mbps_to_bytes(mbps):
+    """
+    Convert a configured megabits per second to bytes per second
+    """
+    if mbps is None:
+        return None
+    return mbps * 1000000 / 8
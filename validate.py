@@ -124,10 +124,118 @@ def validate_config(config):
                 )
                 return False
 
+    for optional_int_key in [
+        "hash_workers",
+        "nanopore_workers",
+        "nanopore_gzip_threads",
+        "nanopore_follow_interval",
+        "nanopore_follow_idle_timeout",
+        "upload_workers",
+        "upload_multipart_threshold",
+        "upload_part_size",
+    ]:
+        if optional_int_key in config:
+            value = config[optional_int_key]
+            if type(value) != int or value < 1:
+                logging.error("Failed to validate config:")
+                logging.error(f"Key {optional_int_key} is not a positive integer")
+                return False
+
+    if "nanopore_gzip_level" in config:
+        value = config["nanopore_gzip_level"]
+        if type(value) != int or not 1 <= value <= 9:
+            logging.error("Failed to validate config:")
+            logging.error("Key nanopore_gzip_level is not an integer from 1 to 9")
+            return False
+
+    if config.get("digest_cache") is not None:
+        if type(config["digest_cache"]) != dict:
+            logging.error("Failed to validate config:")
+            logging.error("Key digest_cache is not a dict or null")
+            return False
+        max_entries = config["digest_cache"].get("max_entries", 10000)
+        if type(max_entries) != int or max_entries < 1:
+            logging.error("Failed to validate config:")
+            logging.error("Key digest_cache.max_entries is not a positive integer")
+            return False
+
+    if config.get("db_cache") is not None:
+        db_cache = config["db_cache"]
+        if type(db_cache) != dict or type(db_cache.get("path")) != str:
+            logging.error("Failed to validate config:")
+            logging.error("Key db_cache is not null or a dict with a path")
+            return False
+        max_size_gb = db_cache.get("max_size_gb", 100)
+        if type(max_size_gb) not in [int, float] or max_size_gb <= 0:
+            logging.error("Failed to validate config:")
+            logging.error("Key db_cache.max_size_gb is not a positive number")
+            return False
+
+    if "streaming_upload" in config and type(config["streaming_upload"]) != bool:
+        logging.error("Failed to validate config:")
+        logging.error("Key streaming_upload is not true or false")
+        return False
+
+    if "pipeline_resources" in config and type(config["pipeline_resources"]) != bool:
+        logging.error("Failed to validate config:")
+        logging.error("Key pipeline_resources is not true or false")
+        return False
+
+    if config.get("upload_bandwidth_mbps") is not None:
+        value = config["upload_bandwidth_mbps"]
+        if type(value) not in [int, float] or value <= 0:
+            logging.error("Failed to validate config:")
+            logging.error("Key upload_bandwidth_mbps is not a positive number")
+            return False
+
+    if "upload_retry" in config:
+        upload_retry_keys = [
+            "max_attempts",
+            "base_delay",
+            "max_delay",
+            "file_deadline",
+            "submission_deadline",
+            "breaker_failures",
+            "breaker_reset",
+        ]
+        if type(config["upload_retry"]) != dict:
+            logging.error("Failed to validate config:")
+            logging.error("Key upload_retry is not a dict")
+            return False
+        for k in config["upload_retry"]:
+            if k not in upload_retry_keys:
+                logging.error("Failed to validate config:")
+                logging.error(f"Unknown key upload_retry.{k}")
+                return False
+        upload_retry = config["upload_retry"]
+        for k in ["max_attempts", "breaker_failures"]:
+            if k in upload_retry:
+                if type(upload_retry[k]) != int or upload_retry[k] < 1:
+                    logging.error("Failed to validate config:")
+                    logging.error(f"Key upload_retry.{k} is not a positive integer")
+                    return False
+        for k in ["base_delay", "max_delay", "breaker_reset"]:
+            if k in upload_retry:
+                if type(upload_retry[k]) not in [int, float] or upload_retry[k] < 0:
+                    logging.error("Failed to validate config:")
+                    logging.error(f"Key upload_retry.{k} is not a number >= 0")
+                    return False
+        for k in ["file_deadline", "submission_deadline"]:
+            if upload_retry.get(k) is not None:
+                if type(upload_retry[k]) not in [int, float] or upload_retry[k] <= 0:
+                    logging.error("Failed to validate config:")
+                    logging.error(
+                        f"Key upload_retry.{k} is not null or a positive number"
+                    )
+                    return False
+
     if "upload" in config:
         if "s3" in config["upload"]:
             if "bucket" in config["upload"]["s3"]:
                 s3_must_have_keys = ["bucket", "s3cmd-config"]
+                if "access_key" in config["upload"]["s3"]:
+                    # the credentials are in the config instead of a s3cmd file
+                    s3_must_have_keys = ["bucket", "access_key", "secret_key"]
                 for upload_must_have_key in s3_must_have_keys:
                     if upload_must_have_key not in config["upload"]["s3"]:
                         logging.error("Failed to validate config:")
@@ -135,8 +243,8 @@ def validate_config(config):
                             f"S3 config s3: key {upload_must_have_key} does not exist"
                         )
                         return False
-                cfg_file = config["upload"]["s3"]["s3cmd-config"]
-                if not validate_filepath(cfg_file):
+                cfg_file = config["upload"]["s3"].get("s3cmd-config")
+                if cfg_file and not validate_filepath(cfg_file):
                     logging.error("Failed to validate config:")
                     logging.error(f"S3 config file: file {cfg_file} does not exist")
                     return False
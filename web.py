@@ -17,6 +17,7 @@ import flask
 import psutil
 
 import catsup
+import progress
 
 APP = flask.Flask("catsup-web")
 
@@ -120,14 +121,8 @@ def config_error_check():
 
     for exe in [
         "nextflow",
-        "curl",
-        "md5sum",
-        "sha1sum",
-        "sha512sum",
-        "s3cmd",
         "kraken2",
         "trim_galore",
-        "seqtk",
     ]:
         if not shutil.which(exe):
             errors.append({"code": "missing_executable", "details": exe})
@@ -327,8 +322,15 @@ def page_nanopore_preprocess(submission_name):
     error = False
     refresh = False
     start = False
+    barcodes = None
     if (pathlib.Path(submission_name) / ".step1.5-running").exists():
         running = True
+        try:
+            with open(pathlib.Path(submission_name) / ".step1.5-running") as f:
+                barcodes = json.loads(f.read())
+        except Exception:
+            # not started yet
+            pass
     if (pathlib.Path(submission_name) / ".step1.5-ok").exists():
         ok = True
     if (pathlib.Path(submission_name) / ".step1.5-error").exists():
@@ -339,8 +341,9 @@ def page_nanopore_preprocess(submission_name):
         start = True
 
     if start:
+        follow = bool(flask.request.args.get("follow"))
         threading.Thread(
-            target=catsup.nanopore_prepare, args=(submission_name,)
+            target=catsup.nanopore_prepare, args=(submission_name, follow)
         ).start()
         return flask.redirect(f"/nanopore_preprocess/{submission_name}?refresh=1")
 
@@ -370,6 +373,7 @@ def page_nanopore_preprocess(submission_name):
         ok=ok,
         error=error,
         refresh=refresh,
+        barcodes=barcodes,
     )
 
 
@@ -574,9 +578,13 @@ def page5(submission_name):
     start = False
     submission_uuid4 = None
     error_content = None
+    upload_progress = None
 
     if (pathlib.Path(submission_name) / ".step4-running").exists():
         running = True
+        upload_progress = progress.read_progress(
+            pathlib.Path(submission_name) / ".step4-progress.json"
+        )
     if (pathlib.Path(submission_name) / ".step4-ok").exists():
         submission_uuid4 = get_submission_uuid4(submission_name)
         ok = True
@@ -609,7 +617,20 @@ def page5(submission_name):
         error=error,
         refresh=refresh,
         error_content=error_content,
+        progress=upload_progress,
+    )
+
+
+@APP.route("/upload/<submission_name>/progress")
+def upload_progress_json(submission_name):
+    """
+    Step 4 progress for polling: bytes sent, throughput and ETA, per file
+    and in total
+    """
+    upload_progress = progress.read_progress(
+        pathlib.Path(submission_name) / ".step4-progress.json"
     )
+    return flask.jsonify(upload_progress or dict())
 
 
 def main():